@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import subprocess
+import sys
+import time
+from Benchmark.LoadModule import *
+from ChatRoom.ServerModule import raise_fd_limit
+
+parser = argparse.ArgumentParser(description='Chat room load generator and benchmark')
+parser.add_argument('scenario', help='the traffic to generate, or all to run every scenario',
+                    choices=sorted(SCENARIOS) + ['all'])
+parser.add_argument('--clients', help='number of connected clients', type=int, default=100)
+parser.add_argument('--duration', help='seconds to generate traffic for', type=float, default=10)
+parser.add_argument('--rate', help='messages per second sent by each sending client, or connections per second '
+                                   'for churn', type=float, default=10)
+parser.add_argument('--senders', help='number of clients sending broadcasts', type=int, default=10)
+parser.add_argument('--payload', help='bytes of padding in each message', type=int, default=PAYLOAD)
+parser.add_argument('--procs', help='number of load generator processes', type=int, default=1)
+parser.add_argument('--server', help='address of a running server to benchmark instead of starting one',
+                    default='localhost')
+parser.add_argument('--port', help='port of a running server to benchmark instead of starting one', type=int)
+parser.add_argument('--server-pid', help='pid of the running server, to report its CPU and memory use', type=int)
+parser.add_argument('--async', help='start the server with the asyncio engine', action='store_true',
+                    dest='use_async')
+parser.add_argument('--workers', help='start the server with worker processes', type=int, default=0)
+parser.add_argument('--flush-delay', help='start the server with this flush delay', type=float, default=0)
+parser.add_argument('--no-compression', help='do not ask the server to compress large messages',
+                    action='store_false', dest='compress')
+parser.add_argument('--steps', help='number of steps the idle scenario connects its clients in, measuring the '
+                                    'server after each', type=int, default=10)
+parser.add_argument('--upgrade-at', help='seconds into each scenario to hot upgrade the server it started',
+                    type=float)
+parser.add_argument('--output', help='JSON file the results are appended to')
+
+args = parser.parse_args()
+if args.upgrade_at is not None and args.workers:
+    parser.error('--upgrade-at can not be combined with --workers, sharded servers can not be upgraded')
+
+
+def free_port():
+    """Returns a port nothing is listening on."""
+    with socket(AF_INET, SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port):
+    """Starts a server in a child process and waits for it to accept connections."""
+    command = [sys.executable, '-m', 'Benchmark.ServerProcess', str(port)]
+    if args.use_async:
+        command.append('--async')
+    if args.workers:
+        command.extend(['--workers', str(args.workers)])
+    if args.flush_delay:
+        command.extend(['--flush-delay', str(args.flush_delay)])
+    process = subprocess.Popen(command)
+    for i in range(100):
+        try:
+            create_connection(('localhost', port)).close()
+            return process
+        except OSError:
+            time.sleep(.05)
+    process.terminate()
+    raise RuntimeError('The server did not start')
+
+
+def run_generator(index, count, names, scenario_name, barrier, results):
+    """Connects a share of the clients and runs the scenario, in a load generator process."""
+    generator = LoadGenerator(args.server, args.port, count, 'b{0}-'.format(index), names, args.procs > 1,
+                              args.compress)
+    scenario = SCENARIOS[scenario_name](args.rate, args.senders // args.procs or 1, args.payload)
+    if scenario_name != 'broadcast':
+        scenario.senders = None
+    generator.connect()
+    barrier.wait()
+    elapsed = generator.run(scenario, args.duration)
+    received_bytes = generator.bytes_received()
+    generator.close()
+    results.put((scenario.latencies.tobytes(), scenario.sent, scenario.received, scenario.failed, elapsed,
+                 received_bytes))
+
+
+def run_scenario(scenario_name, stats, upgrade_pid=None):
+    """Runs one scenario with every load generator and returns its results."""
+    counts = [args.clients // args.procs + (i < args.clients % args.procs) for i in range(args.procs)]
+    names = ['b{0}-{1}'.format(i, j) for i in range(args.procs) for j in range(counts[i])]
+    barrier = multiprocessing.Barrier(args.procs + 1)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_generator,
+                                         args=(i, counts[i], names, scenario_name, barrier, results))
+                 for i in range(args.procs)]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    start = time.monotonic()
+    upgrade_at = args.upgrade_at if upgrade_pid else None
+    if stats:
+        stats.cpu_start = stats.cpu_time()
+    latencies = array('d')
+    sent = received = failed = received_bytes = 0
+    elapsed = 0
+    for i in range(args.procs):
+        while True:
+            if stats:
+                stats.sample()
+            if upgrade_at is not None and time.monotonic() - start >= upgrade_at:
+                os.kill(upgrade_pid, signal.SIGUSR2)
+                upgrade_at = None
+            try:
+                result = results.get(timeout=.5)
+                break
+            except queue.Empty:
+                pass
+        latencies.frombytes(result[0])
+        sent += result[1]
+        received += result[2]
+        failed += result[3]
+        elapsed = max(elapsed, result[4])
+        received_bytes += result[5]
+    for process in processes:
+        process.join()
+    report = describe(scenario_name)
+    report.update({
+        'senders': args.senders if scenario_name == 'broadcast' else args.clients,
+        'upgrade_at': args.upgrade_at if upgrade_pid else None,
+        'sent': sent,
+        'received': received,
+        'failed': failed,
+        'elapsed': elapsed,
+        'sent_per_second': sent / args.duration,
+        'received_per_second': received / elapsed if elapsed else 0,
+        'received_bytes': received_bytes,
+        'latency_ms': percentiles(latencies),
+    })
+    if stats:
+        report['server'] = stats.report(elapsed)
+    return report
+
+
+def run_idle(stats):
+    """Connects quiet clients in steps and measures the server's memory after each step.
+
+    The clients run in this process, answering pings between steps, and
+    turn presence off so joins do not send every client a delta. The memory
+    a connection costs is the growth from the first step to the last
+    divided over the clients connected in between.
+    """
+    generator = LoadGenerator(args.server, args.port, 0, 'idle', shared=True, compress=args.compress,
+                              presence=False)
+    scenario = IdleClients(args.rate)
+    start = time.monotonic()
+    steps = [{'connections': 0, 'rss_kb': stats.resident() if stats else None}]
+    for step in range(1, args.steps + 1):
+        generator.connect(args.clients * step // args.steps - len(generator.clients))
+        generator.run(scenario, args.duration / args.steps, drain=0)
+        if stats:
+            stats.sample()
+        steps.append({'connections': len(generator.clients), 'rss_kb': stats.resident() if stats else None})
+    elapsed = time.monotonic() - start
+    generator.close()
+    first = steps[1] if len(steps) > 2 else steps[0]
+    last = steps[-1]
+    per_connection = None
+    if last['rss_kb'] is not None and first['rss_kb'] is not None and last['connections'] > first['connections']:
+        per_connection = 1024 * (last['rss_kb'] - first['rss_kb']) / (last['connections'] - first['connections'])
+    report = describe('idle')
+    report.update({
+        'connected': len(generator.clients),
+        'elapsed': elapsed,
+        'steps': steps,
+        'bytes_per_connection': per_connection,
+    })
+    if stats:
+        report['server'] = stats.report(elapsed)
+    return report
+
+
+def describe(scenario_name):
+    """Returns the settings a scenario ran with, which start its report."""
+    return {
+        'scenario': scenario_name,
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'clients': args.clients,
+        'duration': args.duration,
+        'rate': args.rate,
+        'payload': args.payload,
+        'procs': args.procs,
+        'engine': 'async' if args.use_async else 'select',
+        'workers': args.workers,
+        'flush_delay': args.flush_delay,
+        'compression': args.compress,
+    }
+
+
+def git_commit():
+    """Returns the commit the benchmark runs on, or None outside a git checkout."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    if report['scenario'] == 'idle':
+        print_memory(report)
+        return
+    latency = report['latency_ms']
+    print('{0}: sent {1} ({2:.0f}/s), received {3} ({4:.0f}/s), failed {5}'.format(
+        report['scenario'], report['sent'], report['sent_per_second'], report['received'],
+        report['received_per_second'], report['failed']))
+    print('  received {0} bytes from the server'.format(report['received_bytes']))
+    if latency['p50'] is not None:
+        print('  latency p50 {0:.2f}ms p99 {1:.2f}ms p999 {2:.2f}ms max {3:.2f}ms'.format(
+            latency['p50'], latency['p99'], latency['p999'], latency['max']))
+    server = report.get('server')
+    if server and server['cpu_seconds'] is not None:
+        print('  server cpu {0:.2f}s ({1:.0f}%), rss max {2} kB'.format(
+            server['cpu_seconds'], server['cpu_percent'], server['rss_max_kb']))
+
+
+def print_memory(report):
+    print('idle: connected {0} clients in {1:.1f}s'.format(report['connected'], report['elapsed']))
+    for step in report['steps']:
+        if step['rss_kb'] is not None:
+            print('  {0:>7} connections, server rss {1} kB'.format(step['connections'], step['rss_kb']))
+    if report['bytes_per_connection'] is not None:
+        print('  {0:.0f} bytes per connection'.format(report['bytes_per_connection']))
+
+
+def main():
+    raise_fd_limit()
+    process = None
+    pid = args.server_pid
+    if args.port is None:
+        args.port = free_port()
+        process = start_server(args.port)
+        pid = process.pid
+    scenarios = sorted(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    reports = []
+    try:
+        for scenario_name in scenarios:
+            stats = ProcessStats(pid) if pid else None
+            if scenario_name == 'idle':
+                report = run_idle(stats)
+            else:
+                report = run_scenario(scenario_name, stats, process.pid if process is not None else None)
+            print_report(report)
+            reports.append(report)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    if args.output:
+        with open(args.output, 'a') as f:
+            for report in reports:
+                f.write(json.dumps(report) + '\n')
+
+if __name__ == '__main__':
+    sys.exit(main())
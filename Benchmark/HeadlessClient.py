@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+from ChatRoom.ClientModule import *
+from ChatRoom.Outbox import *
+
+
+class HeadlessClient(ChatClient):
+    """A ChatClient that hands messages back instead of printing them.
+
+    After the handshake the socket is non-blocking, outgoing data waits in an
+    outbox when the socket is full, so one thread can drive many clients.
+    """
+    def __init__(self, server, port, username, compress=True, presence=True):
+        ChatClient.__init__(self, server, port, username, compress=compress, presence=presence, resume=False)
+        self.bytes_received = 0
+        if self.decoder is None:
+            raise ConnectionError('The server did not answer with the framed protocol')
+        # Measure the server, not Nagle's algorithm delaying the generator's small writes
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self.outbox = Outbox(2 ** 20)
+
+    def send_message(self, tag, message=''):
+        """Queues a message and writes what the socket accepts, returns False if the outbox is full."""
+        if not self.outbox.append(encode_frame(tag, message)):
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        """Writes queued data, returns the number of bytes still waiting."""
+        return self.outbox.flush(self.sock)
+
+    def receive(self):
+        """Reads the messages waiting on the socket, returns None once the server closed it."""
+        frames, self.frames = self.frames, []
+        try:
+            data = self.sock.recv(2 ** 18)
+        except BlockingIOError:
+            return frames
+        if not data:
+            return None
+        self.bytes_received += len(data)
+        for tag, message in self.decoder.feed(data):
+            if tag == 'ping':
+                self.send_message('pong', message)
+            else:
+                frames.append((tag, message))
+        return frames
+
+    def disconnect(self):
+        """Closes the connection without waiting for anything queued."""
+        if self.sock:
+            self.sock.close()
+        self.sock = None
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+import os
+import random
+import selectors
+import time
+from array import array
+from .HeadlessClient import *
+
+TICK = .005
+DRAIN_TIME = 2
+PAYLOAD = 64
+
+
+class Scenario:
+    """Traffic sent by a load generator and the latencies measured from what comes back.
+
+    Subclasses pick who sends what in send_one and read the replies in
+    on_message. Latencies are kept in seconds.
+    """
+    name = None
+
+    def __init__(self, rate, senders=None, payload=PAYLOAD):
+        self.rate = rate
+        self.senders = senders
+        self.payload = 'x' * payload
+        self.latencies = array('d')
+        self.sent = 0
+        self.received = 0
+        self.failed = 0
+
+    def sending_clients(self, generator):
+        """Returns the clients that send, every client unless a number of senders was given."""
+        if self.senders is None:
+            return generator.clients
+        return generator.clients[:self.senders]
+
+    def send_due(self, generator, elapsed):
+        """Sends the messages that are due after elapsed seconds, spread over the sending clients."""
+        senders = self.sending_clients(generator)
+        due = int(elapsed * self.rate * len(senders)) - self.sent
+        for i in range(due):
+            self.send_one(generator, senders[(self.sent + i) % len(senders)])
+        self.sent += max(due, 0)
+
+    def send_one(self, generator, client):
+        raise NotImplementedError
+
+    def on_message(self, generator, client, tag, message, now):
+        pass
+
+    def stamp(self):
+        """Returns the send time and padding put in a message body."""
+        return '{0} {1}'.format(time.monotonic_ns(), self.payload)
+
+    def record(self, body, now):
+        """Records the latency of a message from the send time at the start of its body."""
+        stamp, rest = split_message(body)
+        try:
+            self.latencies.append(now - int(stamp) / 1e9)
+            self.received += 1
+        except (TypeError, ValueError):
+            pass
+
+
+class BroadcastStorm(Scenario):
+    """A few clients broadcast as fast as the rate allows and every client receives everything."""
+    name = 'broadcast'
+
+    def send_one(self, generator, client):
+        generator.send(client, 'message', self.stamp())
+
+    def on_message(self, generator, client, tag, message, now):
+        if tag == 'message':
+            self.record(split_message(message)[1], now)
+
+
+class WhisperHeavy(Scenario):
+    """Every client whispers to other clients picked at random."""
+    name = 'whisper'
+
+    def send_one(self, generator, client):
+        target = random.choice(generator.names)
+        if target == client.username:
+            target = generator.names[0] if target != generator.names[0] else generator.names[-1]
+        generator.send(client, 'whisper', '{0} {1}'.format(target, self.stamp()))
+
+    def on_message(self, generator, client, tag, message, now):
+        if tag == 'whisper':
+            self.record(split_message(message)[1], now)
+
+
+class ListUsersFlood(Scenario):
+    """Every client keeps asking for the whole user list, latency is the time to get the answer."""
+    name = 'listusers'
+
+    def __init__(self, rate, senders=None, payload=PAYLOAD):
+        Scenario.__init__(self, rate, senders, payload)
+        self.pending = {}
+
+    def send_one(self, generator, client):
+        self.pending.setdefault(client, []).append(time.monotonic())
+        generator.send(client, 'username', '-1')
+
+    def on_message(self, generator, client, tag, message, now):
+        if tag == 'username' and self.pending.get(client):
+            self.latencies.append(now - self.pending[client].pop(0))
+            self.received += 1
+
+
+class Churn(Scenario):
+    """Clients connect, say one thing and disconnect, latency is the time to connect."""
+    name = 'churn'
+
+    def __init__(self, rate, senders=None, payload=PAYLOAD):
+        Scenario.__init__(self, rate, senders, payload)
+        self.counter = 0
+
+    def send_due(self, generator, elapsed):
+        due = int(elapsed * self.rate) - self.sent
+        for i in range(max(due, 0)):
+            self.counter += 1
+            name = '{0}churn{1}'.format(generator.prefix, self.counter)
+            start = time.monotonic()
+            try:
+                client = HeadlessClient(generator.server, generator.port, name, generator.compress)
+            except OSError:
+                self.failed += 1
+                continue
+            self.latencies.append(time.monotonic() - start)
+            self.received += 1
+            client.send_message('message', self.stamp())
+            client.disconnect()
+        self.sent += max(due, 0)
+
+
+class IdleClients(Scenario):
+    """Clients that only answer the server's pings, to measure what a quiet connection costs."""
+    name = 'idle'
+
+    def send_due(self, generator, elapsed):
+        pass
+
+
+SCENARIOS = {x.name: x for x in (BroadcastStorm, WhisperHeavy, ListUsersFlood, Churn, IdleClients)}
+
+
+class LoadGenerator:
+    """Drives many headless clients from one thread with a selector."""
+    def __init__(self, server, port, clients, prefix='bench', names=None, shared=False, compress=True,
+                 presence=True):
+        self.server = server
+        self.compress = compress
+        self.presence = presence
+        self.port = port
+        self.prefix = prefix
+        self.count = clients
+        self.names = names or ['{0}{1}'.format(prefix, i) for i in range(clients)]
+        self.shared = shared
+        self.clients = []
+        self.waiting = set()
+        self.selector = selectors.DefaultSelector()
+
+    def connect(self, count=None):
+        """Connects count more clients one after the other, all of them by default."""
+        start = len(self.clients)
+        for i in range(start, start + (self.count if count is None else count)):
+            client = HeadlessClient(self.server, self.port, '{0}{1}'.format(self.prefix, i), self.compress,
+                                    self.presence)
+            self.clients.append(client)
+            self.selector.register(client.sock, selectors.EVENT_READ, client)
+
+    def run(self, scenario, duration, drain=DRAIN_TIME):
+        """Runs a scenario for duration seconds, then keeps reading for up to drain seconds."""
+        start = time.monotonic()
+        end = start + duration
+        while True:
+            now = time.monotonic()
+            if now < end:
+                scenario.send_due(self, now - start)
+            elif now > end + drain or (not self.shared and scenario.received >= self.expected(scenario)):
+                break
+            self.poll(scenario)
+        return time.monotonic() - start
+
+    def send(self, client, tag, message):
+        """Sends a message from a client, watching for the socket to be writable if it did not all fit."""
+        if not client.send_message(tag, message):
+            return False
+        if len(client.outbox) and client not in self.waiting:
+            self.waiting.add(client)
+            self.selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        return True
+
+    def expected(self, scenario):
+        """Returns how many replies the messages sent so far should bring, when this is the only generator."""
+        if isinstance(scenario, BroadcastStorm):
+            return scenario.sent * (len(self.clients) - 1)
+        return scenario.sent
+
+    def poll(self, scenario):
+        """Reads from the clients that are ready and writes what they have queued."""
+        for key, events in self.selector.select(TICK):
+            client = key.data
+            if events & selectors.EVENT_WRITE:
+                if not client.flush():
+                    self.waiting.discard(client)
+                    self.selector.modify(client.sock, selectors.EVENT_READ, client)
+            if events & selectors.EVENT_READ:
+                frames = client.receive()
+                if frames is None:
+                    self.selector.unregister(client.sock)
+                    self.clients.remove(client)
+                    self.waiting.discard(client)
+                    continue
+                now = time.monotonic()
+                for tag, message in frames:
+                    scenario.on_message(self, client, tag, message, now)
+
+    def bytes_received(self):
+        """Returns the bytes the connected clients read from the server, as sent on the wire."""
+        return sum(x.bytes_received for x in self.clients)
+
+    def close(self):
+        for client in self.clients:
+            client.disconnect()
+        self.selector.close()
+
+
+class ProcessStats:
+    """CPU time and peak resident memory of a process and its children, read from /proc.
+
+    Outside Linux the values are None.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.rss_max = 0
+        self.cpu_start = self.cpu_time()
+
+    def pids(self):
+        """Returns the process and its direct children, workers included."""
+        try:
+            with open('/proc/{0}/task/{0}/children'.format(self.pid)) as f:
+                return [self.pid] + [int(x) for x in f.read().split()]
+        except OSError:
+            return [self.pid]
+
+    def cpu_time(self):
+        """Returns the CPU seconds used so far, or None if they can not be read."""
+        total = 0
+        try:
+            for pid in self.pids():
+                with open('/proc/{0}/stat'.format(pid)) as f:
+                    fields = f.read().rpartition(')')[2].split()
+                total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            return None
+        return total / os.sysconf('SC_CLK_TCK')
+
+    def resident(self):
+        """Returns the resident memory in kilobytes, or None if it can not be read."""
+        total = 0
+        try:
+            for pid in self.pids():
+                with open('/proc/{0}/status'.format(pid)) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1])
+        except OSError:
+            return None
+        return total
+
+    def sample(self):
+        """Updates the peak resident memory, in kilobytes."""
+        total = self.resident()
+        if total is not None:
+            self.rss_max = max(self.rss_max, total)
+
+    def report(self, elapsed):
+        """Returns the CPU seconds and percentage used since the start and the peak memory."""
+        cpu = self.cpu_time()
+        if cpu is None or self.cpu_start is None:
+            return {'cpu_seconds': None, 'cpu_percent': None, 'rss_max_kb': self.rss_max or None}
+        cpu -= self.cpu_start
+        return {'cpu_seconds': cpu, 'cpu_percent': 100 * cpu / elapsed, 'rss_max_kb': self.rss_max or None}
+
+
+def percentiles(latencies):
+    """Returns the p50, p99, p999, mean and max of latencies in milliseconds."""
+    if not latencies:
+        return {'p50': None, 'p99': None, 'p999': None, 'mean': None, 'max': None}
+    ordered = sorted(latencies)
+
+    def at(q):
+        return 1000 * ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {'p50': at(.5), 'p99': at(.99), 'p999': at(.999), 'mean': 1000 * sum(ordered) / len(ordered),
+            'max': 1000 * ordered[-1]}
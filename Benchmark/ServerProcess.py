@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import argparse
+import signal
+import sys
+from ChatRoom.ServerModule import *
+from ChatRoom.ShardModule import *
+
+parser = argparse.ArgumentParser(description='Chat room server without the command prompt, for benchmarks. '
+                                             'SIGUSR2 hands the connections to a new process running the code on '
+                                             'disk, sharded servers ignore it')
+parser.add_argument('port', help='the port to listen on', type=int)
+parser.add_argument('--async', help='use the asyncio event loop engine', action='store_true', dest='use_async')
+parser.add_argument('--flush-delay', help='seconds to hold data queued for a client', type=float,
+                    default=FLUSH_DELAY)
+parser.add_argument('--workers', help='number of worker processes sharing the port', type=int, default=0)
+parser.add_argument(UPGRADE_FD_OPTION, help=argparse.SUPPRESS, type=int, dest='upgrade_fd')
+
+
+def main():
+    args = parser.parse_args()
+    server_log.configure(WARNING)
+    if args.use_async:
+        raise_fd_limit()
+    channel = listener = None
+    if args.upgrade_fd is not None:
+        channel, sockets, state = take_over(args.upgrade_fd)
+        listener = sockets[0]
+    if args.workers:
+        server = ShardedServer(args.port, args.workers, args.use_async, flush_delay=args.flush_delay)
+    elif args.use_async:
+        server = AsyncChatServer(args.port, flush_delay=args.flush_delay, listener=listener)
+    else:
+        server = ChatServer(args.port, flush_delay=args.flush_delay, listener=listener)
+    if channel is not None:
+        server.restore(state, sockets)
+        confirm(channel)
+    upgrading = []
+
+    def upgrade(signum, frame):
+        upgrading.append(signum)
+        server.stop()
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    # Sharded servers can not be upgraded
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN if args.workers else upgrade)
+    while True:
+        server.run()
+        if not upgrading:
+            break
+        upgrading.clear()
+        try:
+            successor = hand_off(server, [sys.executable, '-m', 'Benchmark.ServerProcess'] + sys.argv[1:])
+        except UpgradeError as e:
+            server_log.error('{0}', e)
+            continue
+        server_log.close()
+        # Whoever started this process still holds its pid, pass stopping on to the new one
+        signal.signal(signal.SIGTERM, lambda signum, frame: successor.terminate())
+        return successor.wait()
+    server.close()
+    server_log.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
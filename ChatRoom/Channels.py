@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+from .Session import *
+
+MAX_CHANNEL_NAME = 32
+
+
+class ChannelIndex:
+    """Index of the members of each channel.
+
+    Each session also keeps the set of channels it is in, so leaving all of
+    them on disconnect does not scan every channel. Sessions in no channel
+    share NO_CHANNELS instead of each having an empty set.
+
+    Users of other shards and servers are kept apart from the local sessions,
+    they count as members but messages are not sent to them directly.
+    """
+    def __init__(self):
+        self.members = {}
+        self.remote = {}
+
+    def __len__(self):
+        return len(self.members.keys() | self.remote.keys())
+
+    def index(self, session):
+        """Returns the members of each channel of the kind of user given."""
+        return self.remote if isinstance(session, RemoteUser) else self.members
+
+    def join(self, session, channel):
+        """Adds a session to a channel, returns False if it was already a member."""
+        members = self.index(session).setdefault(channel, set())
+        if session in members:
+            return False
+        members.add(session)
+        if not session.channels:
+            session.channels = set()
+        session.channels.add(channel)
+        return True
+
+    def leave(self, session, channel):
+        """Removes a session from a channel, returns False if it was not a member."""
+        index = self.index(session)
+        members = index.get(channel)
+        if members is None or session not in members:
+            return False
+        members.remove(session)
+        session.channels.discard(channel)
+        if not session.channels:
+            session.channels = NO_CHANNELS
+        if not members:
+            del index[channel]
+        return True
+
+    def leave_all(self, session):
+        """Removes a session from every channel it is in and returns those channels."""
+        channels = list(session.channels)
+        for channel in channels:
+            self.leave(session, channel)
+        return channels
+
+    def subscribers(self, channel):
+        """Returns the local sessions in a channel."""
+        return self.members.get(channel, ())
+
+    def count(self, channel):
+        """Returns the number of members of a channel, on every shard and server."""
+        return len(self.members.get(channel, ())) + len(self.remote.get(channel, ()))
+
+    def listing(self):
+        """Returns (channel, member count) for every channel, sorted by name."""
+        return [(channel, self.count(channel)) for channel in sorted(self.members.keys() | self.remote.keys())]
+
+
+def channel_name(name):
+    """Normalizes a channel name, returns None if it is not valid."""
+    name = name.strip().lstrip('#')
+    if not name or len(name) > MAX_CHANNEL_NAME or len(name.split()) != 1:
+        return None
+    return name
@@ -1,131 +1,329 @@
 #!/usr/bin/env python3
-import select
-from .PostMessage import *
+import queue
+import threading
+from .Protocol import *
+from .Presence import *
 from socket import *  # import *, but we'll avoid name conflict
 
+HANDSHAKE_TIMEOUT = 5
+FATAL_ERRORS = ('name_taken', 'slow_consumer', 'flooding', 'idle_timeout')
+
+
+class ChatEvent:
+    """A message from the server, parsed into named fields.
+
+    Every event has the tag and raw body it came from, the other fields
+    depend on the tag, see parse_event.
+    """
+    def __init__(self, tag, body='', **fields):
+        self.tag = tag
+        self.body = body
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        fields = ', '.join('{0}={1!r}'.format(k, v) for k, v in sorted(self.__dict__.items()) if k != 'body')
+        return 'ChatEvent({0})'.format(fields)
+
 
 class ChatClient:
-    def __init__(self, server, port, username):
-        self.sock = socket(AF_INET, SOCK_STREAM)
-        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.sock.connect((server, port))
-        self.sock.send(username.encode())
+    """A connection to a chat server that delivers what the server sends as events.
+
+    Events are handed to the listeners registered with add_listener, or
+    yielded by events(). Both are fed by a reader thread that blocks on the
+    socket, so an idle client uses no CPU. The connection always ends with a
+    closed event, whose expected field tells if the client or server meant to
+    close it. Servers that only speak the legacy protocol would take the
+    framed hello for a username, so they must be connected to with legacy
+    set, a server that does not answer the hello with frames is refused.
+
+    With presence the server announces joins and leaves in batched presence
+    events, without it the client hears nothing about them. The reader
+    thread answers the server's pings itself, listeners never see them.
+
+    With resume the server numbers the messages it sends and hands out a
+    token, resumable() then gives what a new client needs to pick up where
+    this one stopped. Passing that as resume connects as the same session and
+    replays the messages missed in between, ending with a resumed event.
+    Only the server process that gave out the token knows it, a sharded
+    server may send the new connection to another worker, which answers
+    with a resume_failed error and a fresh session.
+    """
+    def __init__(self, server, port, username, legacy=False, compress=True, presence=True, resume=True):
         self.username = username
+        self.compress = compress
+        self.presence = presence
+        self.resume = resume
+        self.sequenced = False
+        self.token = None
+        self.last_seq = None
+        self.decoder = None
+        self.frames = []
+        self.listeners = []
+        self.thread = None
+        self.closing = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.sock = open_socket(server, port)
+        if legacy:
+            self.sock.send(username.encode())
+            return
+        try:
+            framed = self.negotiate()
+        except timeout:
+            self.sock.close()
+            raise ConnectionError('{0}:{1} did not answer the hello within {2}s'.format(
+                server, port, HANDSHAKE_TIMEOUT))
+        if not framed:
+            self.sock.close()
+            raise ConnectionError('{0}:{1} does not speak the framed protocol, connect as a legacy client'.format(
+                server, port))
 
-    # def check(self):
-    #     """Checks the connection to the server for new messages."""
-    #     to_read = list(sys.stdin)
-    #     read, write, err = select.select(to_read, [], [], 0)
-    #     if sys.stdin in read:
-    #         return sys.stdin.readline
-    #     else:
-    #         self.receive_message()
-    #         return ''
-
-    def send_message(self, message):
-        """Sends a message to the server."""
-        message_len = self.sock.send(message.encode())
-
-        if message_len != len(message):
-            print("Failed to send complete message")
-
-    def receive_message(self):
-        """Checks the connection with the server and receives a message if available."""
-        read, write, err = select.select([self.sock], [], [], 0)
-        if self.sock in read:
-            message = self.sock.recv(2 ** 16).strip().decode()
-            if message:
-                tag, message = split_message(message)
-                if tag == 'no_message':
-                    pass
-                elif tag == 'message':
-                    username, message = split_message(message)
-                    message_format = '[{0}] said: {1}\n'
-                    message = message_format.format(username, message)
-                    post_message('[Me] ', message)
-                elif tag == 'username':
-                    self.username_list(message)
-                elif tag == 'disconnection':
-                    message_format = '{0} has disconnected.\n'
-                    message = message_format.format(message)
-                    post_message('[Me] ', message)
-                elif tag == 'connection':
-                    message_format = '{0} has connected.\n'
-                    message = message_format.format(message)
-                    post_message('[Me] ', message)
-                elif tag == 'error':
-                    return self.error_message(message)
-                elif tag == 'shutdown':
-                    post_message('[Me] ', 'Server has shutdown.\n')
-                    self.disconnect()
-                    return'disconnect'
-                elif tag == 'whisper':
-                    username, message = split_message(message)
-                    message_format = '[{0}] whispers: {1}\n'
-                    message = message_format.format(username, message)
-                    post_message('[Me] ', message)
-            else:
-                self.disconnect()
-                post_message('[Me] ', 'Lost connection to server.\n')
-                return True
-
-    def username_list(self, message):
-        """"Displays the username list sent from the server to the user."""
-        extras, usernames = split_message(message)
-        extras = int(extras)
-        usernames = usernames.split()
-        if extras == 0:
-            if len(usernames) == 1:
-                message = usernames[0]
-                message_format = 'You, "{0}", are the only user connected.\n'
-            elif len(usernames) == 2:
-                usernames.remove(self.username)
-                message = usernames[0]
-                message_format = 'You and {0} are the only users connected.\n'
-            else:
-                message = ', '.join(usernames[:-1])
-                message_format = 'The connected users are {0}, and {1}.\n'
-            message = message_format.format(message, usernames[-1])
-        else:
-            if len(usernames) == 0:
-                message_format = 'There are {0} users currently connected\n'
-                message = message_format.format(extras)
+    def negotiate(self):
+        """Offers the framed protocol to the server, returns False if the server does not answer with frames.
+
+        A server that does not answer at all raises timeout.
+
+        Compression is offered too, the server only sends compressed frames
+        if it accepted it, so the decoder can inflate from the start.
+        """
+        hello = '{0} {1}'.format(PROTOCOL_VERSION, self.username)
+        if self.compress:
+            hello += ' ' + COMPRESSION
+        hello += ' ' + (PRESENCE if self.presence else NO_PRESENCE)
+        if self.resume is True:
+            hello += ' ' + RESUME
+        elif self.resume:
+            hello += ' {0}={1}:{2}'.format(RESUME, *self.resume)
+        self.sock.send(encode_frame('hello', hello))
+        self.sock.settimeout(HANDSHAKE_TIMEOUT)
+        decoder = FrameDecoder(inflate=self.compress)
+        try:
+            data = self.sock.recv(2 ** 16)
+            if not is_frame(data):
+                return False
+            frames = decoder.feed(data)
+            while not frames and data:
+                data = self.sock.recv(2 ** 16)
+                frames = decoder.feed(data)
+        except ProtocolError:
+            return False
+        finally:
+            self.sock.settimeout(None)
+        if frames and frames[0][0] == 'hello':
+            tag, options = frames.pop(0)
+            self.sequenced = RESUME in options.split()
+        self.decoder = decoder
+        self.frames = frames
+        return True
+
+    def add_listener(self, callback):
+        """Calls callback with every event from now on, on the reader thread."""
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def start(self):
+        """Starts the reader thread that delivers events to the listeners."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.read_loop, daemon=True)
+            self.thread.start()
+
+    def wait(self, timeout=None):
+        """Waits for the reader thread to deliver the closed event."""
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def events(self):
+        """Returns an iterator over the events from now on, up to and including the closed event."""
+        events = queue.SimpleQueue()
+        with self.lock:
+            if self.closed:
+                return iter(())
+            self.add_listener(events.put)
+        self.start()
+        return self.iterate(events)
+
+    def iterate(self, events):
+        try:
+            while True:
+                event = events.get()
+                yield event
+                if event.tag == 'closed':
+                    return
+        finally:
+            self.remove_listener(events.put)
+
+    def read_loop(self):
+        """Reads and delivers events until the connection closes, run by the reader thread."""
+        expected = False
+        while True:
+            events = self.read_events()
+            if events is None:
+                break
+            for event in events:
+                if event.tag == 'ping':
+                    self.pong(event)
+                    continue
+                self.dispatch(event)
+                if event.tag == 'shutdown' or (event.tag == 'error' and event.code in FATAL_ERRORS):
+                    expected = True
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        with self.lock:
+            # Listeners added from now on would never see the closed event
+            self.closed = True
+        self.dispatch(ChatEvent('closed', expected=expected or self.closing))
+
+    def read_events(self):
+        """Blocks until the server sends something and returns it as events, None once the connection closes."""
+        frames, self.frames = self.frames, []
+        if not frames:
+            try:
+                data = self.sock.recv(2 ** 16)
+            except OSError:
+                return None
+            if not data:
+                return None
+            if self.decoder is None:
+                frames = [split_message(data.decode())]
             else:
-                if len(usernames) == 1:
-                    message_format = 'The connected users are {0} and {1} more.\n'
+                try:
+                    frames = self.decoder.feed(data)
+                except (ProtocolError, UnicodeDecodeError):
+                    return None
+        if not self.sequenced:
+            return [parse_event(tag, message) for tag, message in frames]
+        events = []
+        for tag, message in frames:
+            seq = None
+            if tag == 'session':
+                token, seq = split_message(message)
+                self.token = None if token == '-' else token
+                self.last_seq = int(seq)
+                continue
+            if tag in SEQUENCED_TAGS:
+                number, message = split_message(message)
+                try:
+                    seq = int(number)
+                except ValueError:
+                    message = '{0} {1}'.format(number, message)
                 else:
-                    message_format = 'The connected users are {0}, and {1} more.\n'
-                message = ', '.join(usernames)
-                message = message_format.format(message, extras)
-        post_message('[Me] ', message)
-
-    def error_message(self, message):
-        """"Displays the error message sent from the server to the user."""
-        tag, message = split_message(message)
-        if tag == 'name_taken':
-            self.disconnect()
-            message_format = 'ERROR: Username {0} already taken, use ' \
-                             '"\\username" to choose a new one.\n'
-            message = message_format.format(self.username)
-            post_message('[Me] ', message)
-            return 'disconnect'
-        elif tag == 'no_name_whisper':
-            message_format = 'ERROR: Unable to whisper, user {0} not found.\n'
-            message = message_format.format(message)
-            post_message('[Me] ', message)
+                    # A replay may still be running when the first live messages come in
+                    self.last_seq = max(self.last_seq or 0, seq)
+            event = parse_event(tag, message)
+            if seq is not None:
+                event.seq = seq
+            events.append(event)
+        return events
+
+    def resumable(self):
+        """Returns the token and last sequence number to resume this session with, or None if it can not be."""
+        if self.token is None or self.last_seq is None:
+            return None
+        return self.token, self.last_seq
+
+    def dispatch(self, event):
+        """Hands an event to every listener."""
+        for callback in list(self.listeners):
+            callback(event)
+
+    def pong(self, event):
+        """Answers a ping from the server, a failure shows up as the connection closing."""
+        try:
+            self.send_message('pong', event.body)
+        except (OSError, AttributeError):
+            pass
+
+    def send_message(self, tag, message=''):
+        """Sends a message to the server, safe to call from any thread."""
+        if self.decoder is None:
+            data = encode_legacy(tag, message)
+        else:
+            data = encode_frame(tag, message)
+        with self.send_lock:
+            self.sock.sendall(data)
 
     def disconnect(self):
-        """Disconnects from the server."""
+        """Disconnects from the server, the reader thread then delivers the closed event."""
+        self.closing = True
         if self.sock:
-            self.sock.shutdown(SHUT_RDWR)
-            self.sock.close()
-        self.sock = None
+            try:
+                self.sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            if self.thread is None:
+                self.sock.close()
+                self.sock = None
+
+
+def parse_event(tag, message):
+    """Parses a message from the server into an event, keeping only the tag and body if it is malformed."""
+    try:
+        return parse_fields(tag, message)
+    except ValueError:
+        return ChatEvent(tag, message)
+
+
+def parse_fields(tag, message):
+    if tag in ('message', 'whisper'):
+        sender, text = split_message(message)
+        return ChatEvent(tag, message, sender=sender, text=text)
+    elif tag in ('connection', 'disconnection'):
+        return ChatEvent(tag, message, name=message)
+    elif tag == 'username':
+        extras, names = split_message(message)
+        return ChatEvent(tag, message, extras=int(extras), names=names.split())
+    elif tag == 'error':
+        code, detail = split_message(message)
+        return ChatEvent(tag, message, code=code, detail=detail)
+    elif tag == 'channel':
+        channel, rest = split_message(message)
+        sender, text = split_message(rest)
+        return ChatEvent(tag, message, channel=channel, sender=sender, text=text)
+    elif tag == 'joined':
+        channel, count = split_message(message)
+        return ChatEvent(tag, message, channel=channel, count=int(count))
+    elif tag == 'left':
+        return ChatEvent(tag, message, channel=message)
+    elif tag in ('channel_join', 'channel_leave'):
+        channel, name = split_message(message)
+        return ChatEvent(tag, message, channel=channel, name=name)
+    elif tag == 'channels':
+        channels = [x.rpartition(':') for x in message.split()]
+        return ChatEvent(tag, message, channels=[(name, int(count)) for name, sep, count in channels])
+    elif tag == 'history':
+        seq, rest = split_message(message)
+        kind, rest = split_message(rest)
+        target = channel = None
+        if kind == 'whisper':
+            target, rest = split_message(rest)
+        elif kind == 'channel':
+            channel, rest = split_message(rest)
+        sender, text = split_message(rest)
+        return ChatEvent(tag, message, seq=int(seq), kind=kind, target=target, channel=channel, sender=sender,
+                         text=text)
+    elif tag == 'presence':
+        joined, left = decode_delta(message)
+        return ChatEvent(tag, message, joined=joined, left=left)
+    elif tag == 'users':
+        return ChatEvent(tag, message, names=message.split())
+    elif tag == 'users_end':
+        cursor, total = split_message(message)
+        return ChatEvent(tag, message, cursor=None if cursor == '-' else cursor, total=int(total))
+    elif tag == 'resumed':
+        count, missed = split_message(message)
+        return ChatEvent(tag, message, count=int(count), missed=int(missed or 0))
+    elif tag == 'history_end':
+        return ChatEvent(tag, message, count=int(message))
+    return ChatEvent(tag, message)
 
 
-def split_message(message):
-    """Splits a message into its tag and the body of the message"""
-    split = message.strip().split(sep=None, maxsplit=1)
-    if len(split) < 2:
-        return split[0], ''
-    else:
-        return split[0], split[1]
+def open_socket(server, port):
+    """Opens a TCP connection to the server."""
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    sock.connect((server, port))
+    return sock
@@ -1,24 +1,39 @@
 #!/usr/bin/env python3
+import cmd
+import random
 import threading
 import time
-import cmd
+from .PostMessage import *
 from .ClientModule import *
 
+USERS_PAGE = 20
+RECONNECT_BASE = .5
+RECONNECT_CAP = 30
+
 
 class ChatClientCMD(cmd.Cmd):
     prompt = '[Me] '
     file = None
     done = True
 
-    def __init__(self, server, port, username):
+    def __init__(self, server, port, username, presence=True, reconnect=True, render_interval=RENDER_INTERVAL,
+                 max_backlog=MAX_BACKLOG, legacy=False):
         cmd.Cmd.__init__(self)
 
         self.server = server
         self.port = port
         self.username = username
+        self.presence = presence
+        self.reconnect = reconnect
+        self.legacy = legacy
+        self.render_interval = render_interval
+        self.max_backlog = max_backlog
+        self.reconnecting = False
         self.chat_client = None
-        self.receive_thread = None
         self.connect = False
+        self.channel = None
+        self.users_page = None
+        self.users_cursor = None
 
     @staticmethod
     def no_server(verbose=True):
@@ -45,55 +60,148 @@ class ChatClientCMD(cmd.Cmd):
         post_message('[Me] ', message, True)
 
     def do_message(self, line):
-        """Sends a message to the server that the other users can see."""
+        """Sends a message to the current channel, or to every user when not in a channel."""
+        if self.connect:
+            if self.channel:
+                self.chat_client.send_message('channel', '{0} {1}'.format(self.channel, line))
+            else:
+                self.chat_client.send_message('message', line)
+        else:
+            self.no_server()
+
+    def do_join(self, line):
+        """Joins the given channel and makes it the current channel."""
+        if self.connect:
+            channel = line.strip().lstrip('#')
+            if channel:
+                self.channel = channel
+                self.chat_client.send_message('join', channel)
+        else:
+            self.no_server()
+
+    def do_leave(self, line):
+        """Leaves the given channel, or the current one if none is given."""
         if self.connect:
-            message = 'message ' + line
-            self.chat_client.send_message(message)
+            channel = line.strip().lstrip('#') or self.channel
+            if channel:
+                if channel == self.channel:
+                    self.channel = None
+                self.chat_client.send_message('leave', channel)
+        else:
+            self.no_server()
+
+    def do_history(self, line):
+        """Replays the last N messages (20 by default), or the messages since a sequence number with "since N"."""
+        if self.connect:
+            split = line.split()
+            if not split:
+                split = ['last', '20']
+            elif len(split) == 1:
+                split = ['last'] + split
+            self.chat_client.send_message('history', ' '.join(split))
+        else:
+            self.no_server()
+
+    def do_channels(self, line):
+        """Requests a list of channels from the server."""
+        if self.connect:
+            self.chat_client.send_message('channels')
         else:
             self.no_server()
 
     def do_listusers(self, line):
-        """Requests a list of users from the server."""
+        """Lists the users a page at a time: "listusers [N] [prefix]", N is -1 for every user."""
         if self.connect:
-            message = 'username ' + line.strip()
-            self.chat_client.send_message(message)
+            if self.chat_client.decoder is None:
+                # Servers speaking the legacy protocol only know the single message list
+                self.chat_client.send_message('username', line.strip())
+                return
+            count, prefix = split_message(line)
+            try:
+                count = int(count)
+            except ValueError:
+                count, prefix = USERS_PAGE, line.strip()
+            self.users_page = (count, prefix)
+            self.chat_client.send_message('users', '{0} - {1}'.format(count, prefix))
         else:
             self.no_server()
 
+    def do_more(self, line):
+        """Lists the next page of users."""
+        if not self.connect:
+            self.no_server()
+        elif self.users_cursor is None:
+            post_message('[Me] ', 'There are no more users to list.\n', True)
+        else:
+            count, prefix = self.users_page
+            self.chat_client.send_message('users', '{0} {1} {2}'.format(count, self.users_cursor, prefix))
+
     def do_connect(self, line):
         """Connects to the server with the specified address, port and username."""
         if not self.connect:
+            self.reconnecting = False
             try:
-                self.chat_client = ChatClient(self.server, self.port, self.username)
+                chat_client = ChatClient(self.server, self.port, self.username, self.legacy,
+                                         presence=self.presence)
             except ConnectionRefusedError:
                 message_format = 'ERROR: Connection to {0}:{1} refused. Unable to connect\n'
                 message = message_format.format(self.server, self.port)
                 post_message('[Me] ', message, True)
+            except ConnectionError as e:
+                post_message('[Me] ', 'ERROR: {0}.\n'.format(e), True)
             else:
-                self.connect = True
-                self.receive_thread = ReceiveThread(self, self.chat_client)
-                self.receive_thread.start()
+                self.channel = None
+                self.attach(chat_client)
         else:
             self.yes_server()
 
+    def attach(self, chat_client):
+        """Starts showing the events of a new connection."""
+        self.chat_client = chat_client
+        self.connect = True
+        chat_client.add_listener(self.handle_event)
+        chat_client.start()
+
+    def reconnect_loop(self, resume):
+        """Reconnects after the connection was lost, resuming the session if the server still has it.
+
+        Each wait is random and its range doubles after every failed
+        attempt, so the clients of a server that went away for a moment do
+        not all come back at the same time.
+        """
+        attempt = 0
+        while self.reconnecting:
+            time.sleep(random.uniform(0, min(RECONNECT_CAP, RECONNECT_BASE * 2 ** attempt)))
+            if not self.reconnecting:
+                return
+            try:
+                chat_client = ChatClient(self.server, self.port, self.username, self.legacy,
+                                         presence=self.presence, resume=resume or True)
+            except OSError:
+                attempt += 1
+                continue
+            self.reconnecting = False
+            post_message('[Me] ', 'Reconnected to the server.\n')
+            self.attach(chat_client)
+
     def do_disconnect(self, line):
         """Disconnects from the server."""
+        self.reconnecting = False
         if self.connect:
             self.connect = False
-            time.sleep(.1)
             self.chat_client.disconnect()
+            self.chat_client.wait()
         else:
             self.no_server()
 
     def do_close(self, line):
         """Disconnects from the server, then shuts down the client."""
+        self.reconnecting = False
         if self.connect:
             self.connect = False
-            time.sleep(.1)
             self.chat_client.disconnect()
-            return True
-        else:
-            return True
+            self.chat_client.wait()
+        return True
 
     def do_server(self, line):
         """Sets the server's address to the given address."""
@@ -125,8 +233,7 @@ class ChatClientCMD(cmd.Cmd):
     def do_whisper(self, line):
         """Sends a message to a given user that only they can see."""
         if self.connect:
-            message = 'whisper ' + line
-            self.chat_client.send_message(message)
+            self.chat_client.send_message('whisper', line)
         else:
             self.no_server()
 
@@ -146,20 +253,166 @@ class ChatClientCMD(cmd.Cmd):
         return line
 
     def preloop(self):
+        if self.render_interval:
+            # A busy room would otherwise redraw the prompt for every message
+            renderer.configure(self.render_interval, self.max_backlog)
         post_message('[Me] ', 'Welcome to the chat client.\n', True)
         self.do_connect(None)
 
+    def postloop(self):
+        renderer.flush()
+
+    def handle_event(self, event):
+        """Displays an event from the server, called by the client's reader thread."""
+        tag = event.tag
+        if tag == 'message':
+            post_message('[Me] ', '[{0}] said: {1}\n'.format(event.sender, event.text))
+        elif tag == 'username':
+            self.username_list(event)
+        elif tag == 'disconnection':
+            post_message('[Me] ', '{0} has disconnected.\n'.format(event.name))
+        elif tag == 'connection':
+            post_message('[Me] ', '{0} has connected.\n'.format(event.name))
+        elif tag == 'presence':
+            self.presence_message(event)
+        elif tag == 'error':
+            self.error_message(event)
+        elif tag == 'shutdown':
+            post_message('[Me] ', 'Server has shutdown.\n')
+        elif tag == 'whisper':
+            post_message('[Me] ', '[{0}] whispers: {1}\n'.format(event.sender, event.text))
+        elif tag == 'channel':
+            post_message('[Me] ', '[#{0}] [{1}] said: {2}\n'.format(event.channel, event.sender, event.text))
+        elif tag == 'joined':
+            post_message('[Me] ', 'You joined #{0}, it has {1} members.\n'.format(event.channel, event.count))
+        elif tag == 'left':
+            post_message('[Me] ', 'You left #{0}.\n'.format(event.channel))
+        elif tag == 'channel_join':
+            post_message('[Me] ', '{0} joined #{1}.\n'.format(event.name, event.channel))
+        elif tag == 'channel_leave':
+            post_message('[Me] ', '{0} left #{1}.\n'.format(event.name, event.channel))
+        elif tag == 'channels':
+            self.channel_list(event)
+        elif tag == 'history':
+            self.history_message(event)
+        elif tag == 'history_end':
+            post_message('[Me] ', 'End of history, {0} messages.\n'.format(event.count))
+        elif tag == 'users':
+            post_message('[Me] ', 'Users: {0}\n'.format(', '.join(event.names)))
+        elif tag == 'users_end':
+            self.users_end(event)
+        elif tag == 'resumed':
+            self.resumed_message(event)
+        elif tag == 'closed':
+            self.connect = False
+            if not event.expected:
+                post_message('[Me] ', 'Lost connection to server.\n')
+                if self.reconnect and not self.reconnecting:
+                    self.reconnecting = True
+                    threading.Thread(target=self.reconnect_loop, args=(self.chat_client.resumable(),),
+                                     daemon=True).start()
+
+    def resumed_message(self, event):
+        """Displays how many messages were replayed after resuming the session."""
+        message = 'Caught up on {0} missed messages'.format(event.count)
+        if event.missed:
+            message += ', {0} more were too old to replay'.format(event.missed)
+        post_message('[Me] ', message + '.\n')
+
+    def presence_message(self, event):
+        """Displays the users that connected and disconnected since the last presence event."""
+        joined = [x for x in event.joined if x != self.username]
+        for names, action in ((joined, 'connected'), (event.left, 'disconnected')):
+            if len(names) == 1:
+                post_message('[Me] ', '{0} has {1}.\n'.format(names[0], action))
+            elif names:
+                post_message('[Me] ', '{0} have {1}.\n'.format(', '.join(names), action))
+
+    def username_list(self, event):
+        """"Displays the username list sent from the server to the user."""
+        extras = event.extras
+        usernames = list(event.names)
+        if extras == 0:
+            if len(usernames) == 1:
+                message = usernames[0]
+                message_format = 'You, "{0}", are the only user connected.\n'
+            elif len(usernames) == 2:
+                usernames.remove(self.username)
+                message = usernames[0]
+                message_format = 'You and {0} are the only users connected.\n'
+            else:
+                message = ', '.join(usernames[:-1])
+                message_format = 'The connected users are {0}, and {1}.\n'
+            message = message_format.format(message, usernames[-1])
+        else:
+            if len(usernames) == 0:
+                message_format = 'There are {0} users currently connected\n'
+                message = message_format.format(extras)
+            else:
+                if len(usernames) == 1:
+                    message_format = 'The connected users are {0} and {1} more.\n'
+                else:
+                    message_format = 'The connected users are {0}, and {1} more.\n'
+                message = ', '.join(usernames)
+                message = message_format.format(message, extras)
+        post_message('[Me] ', message)
 
-class ReceiveThread(threading.Thread):
-    """Creates a separate thread to check the socket that is connected to the server."""
-    def __init__(self, chat_cmd, chat_client):
-        threading.Thread.__init__(self)
-        self.cmd = chat_cmd
-        self.client = chat_client
+    def users_end(self, event):
+        """Displays the end of a page of users."""
+        self.users_cursor = event.cursor
+        prefix = self.users_page[1] if self.users_page else ''
+        message = '{0} users'.format(event.total)
+        if prefix:
+            message += ' starting with {0}'.format(prefix)
+        if event.cursor is not None:
+            message += ', use "\\more" to list more'
+        post_message('[Me] ', message + '.\n')
+
+    def history_message(self, event):
+        """Displays a message replayed from the server's history."""
+        if event.kind == 'whisper':
+            message_format = '[history {0}] [{1}] whispered to {2}: {3}\n'
+            message = message_format.format(event.seq, event.sender, event.target, event.text)
+        elif event.kind == 'channel':
+            message_format = '[history {0}] [#{1}] [{2}] said: {3}\n'
+            message = message_format.format(event.seq, event.channel, event.sender, event.text)
+        else:
+            message_format = '[history {0}] [{1}] said: {2}\n'
+            message = message_format.format(event.seq, event.sender, event.text)
+        post_message('[Me] ', message)
+
+    @staticmethod
+    def channel_list(event):
+        """Displays the channel list sent from the server to the user."""
+        if event.channels:
+            message = ', '.join('#{0} ({1})'.format(name, count) for name, count in event.channels)
+            message = 'The channels are {0}.\n'.format(message)
+        else:
+            message = 'There are no channels.\n'
+        post_message('[Me] ', message)
 
-    def run(self):
-        time.sleep(.1)
-        while self.cmd.connect:
-            message = self.client.receive_message()
-            if message :
-                self.cmd.connect = False
+    def error_message(self, event):
+        """"Displays the error message sent from the server to the user."""
+        if event.code == 'name_taken':
+            message_format = 'ERROR: Username {0} already taken, use ' \
+                             '"\\username" to choose a new one.\n'
+            post_message('[Me] ', message_format.format(self.username))
+        elif event.code == 'slow_consumer':
+            post_message('[Me] ', 'ERROR: Disconnected by the server for falling too far behind.\n')
+        elif event.code == 'flooding':
+            post_message('[Me] ', 'ERROR: Disconnected by the server for sending too fast.\n')
+        elif event.code == 'resume_failed':
+            self.channel = None
+            post_message('[Me] ', 'The server no longer had your session, messages sent meanwhile were missed.\n')
+        elif event.code == 'idle_timeout':
+            post_message('[Me] ', 'ERROR: Disconnected by the server for not answering.\n')
+        elif event.code == 'rate_limited':
+            post_message('[Me] ', 'ERROR: Sending too fast, messages are being dropped.\n')
+        elif event.code == 'no_name_whisper':
+            message_format = 'ERROR: Unable to whisper, user {0} not found.\n'
+            post_message('[Me] ', message_format.format(event.detail))
+        elif event.code == 'bad_history':
+            post_message('[Me] ', 'ERROR: Use "\\history N" or "\\history since N".\n')
+        elif event.code == 'no_channel':
+            message_format = 'ERROR: You are not in a channel named {0}.\n'
+            post_message('[Me] ', message_format.format(event.detail))
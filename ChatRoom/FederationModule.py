@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+import time
+import errno
+import hmac
+from collections import deque
+from .ServerLog import *
+from .Protocol import *
+from .Outbox import *
+from .Session import *
+from socket import *
+
+SEEN_EVENTS = 2 ** 16
+RETRY_INTERVAL = 5
+CONNECT_TIMEOUT = 1
+
+
+class PeerLink:
+    """A TCP link to another server of the federation."""
+    def __init__(self, federation, connection, address, peer_id=None, dialed=False, decoder=None):
+        self.federation = federation
+        self.connection = connection
+        self.address = address
+        self.peer_id = peer_id
+        self.dialed = dialed
+        self.decoder = decoder or FrameDecoder()
+        self.outbox = Outbox(4 * HIGH_WATER)
+
+    def send(self, tag, message):
+        """Sends a new event to the server on the other end of the link."""
+        self.federation.forward(self, tag, self.federation.next_event(), message)
+
+
+class Federation:
+    """Relays events between this server and its peers.
+
+    Every event carries an id made of the server it started on and a counter.
+    Servers forward each event to all their other peers the first time they
+    see it, so any topology works, including ones with loops. Frames queued
+    for a peer are written together once the current batch of reads is done.
+
+    When two servers accept the same username at the same time, the user on
+    the server with the smallest id keeps the name.
+
+    Peers are dialed without blocking, the server watches a dialing socket
+    until it is writable and then calls connected.
+
+    A peer link carries events said to come from any user, so a server only
+    accepts links from servers whose hello has the same secret as its own.
+    Without a secret it dials its peers but accepts no links.
+    """
+    def __init__(self, server_id, peers=(), secret=None):
+        self.server_id = server_id
+        self.secret = secret
+        self.server = None
+        self.links = {}
+        self.dialing = [(address, 0) for address in peers]
+        self.connecting = {}
+        self.counter = 0
+        self.seen = set()
+        self.seen_order = deque()
+        self.dirty = set()
+
+    def attach(self, server):
+        """Starts federating the given server."""
+        self.server = server
+        self.dial()
+
+    def next_event(self):
+        """Returns a new event id."""
+        self.counter += 1
+        return '{0}/{1}'.format(self.server_id, self.counter)
+
+    def mark_seen(self, event):
+        """Remembers an event, returns False if it was already seen."""
+        if event in self.seen:
+            return False
+        self.seen.add(event)
+        self.seen_order.append(event)
+        if len(self.seen_order) > SEEN_EVENTS:
+            self.seen.discard(self.seen_order.popleft())
+        return True
+
+    def dial(self):
+        """Starts connecting to the configured peers that are not linked yet, and gives up on slow attempts."""
+        now = time.monotonic()
+        for connection, (address, deadline) in list(self.connecting.items()):
+            if deadline <= now:
+                self.connect_failed(connection, address)
+        waiting = []
+        for address, next_try in self.dialing:
+            if next_try > now:
+                waiting.append((address, next_try))
+                continue
+            connection = socket(AF_INET, SOCK_STREAM)
+            connection.setblocking(False)
+            try:
+                error = connection.connect_ex(address)
+            except OSError:
+                error = errno.EHOSTUNREACH
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                connection.close()
+                waiting.append((address, now + RETRY_INTERVAL))
+                continue
+            self.connecting[connection] = (address, now + CONNECT_TIMEOUT)
+            self.server.set_writable(connection, True)
+        self.dialing = waiting
+
+    def connected(self, connection):
+        """Links a peer once its dialing socket is writable, or retries later if the connect failed."""
+        address, deadline = self.connecting[connection]
+        if connection.getsockopt(SOL_SOCKET, SO_ERROR):
+            self.connect_failed(connection, address)
+            return
+        del self.connecting[connection]
+        self.server.set_writable(connection, False)
+        link = PeerLink(self, connection, address, dialed=True)
+        link.outbox.append(encode_frame('peer', '{0} {1}'.format(self.server_id, self.secret or '')))
+        self.dirty.add(link)
+        self.add_link(link)
+
+    def connect_failed(self, connection, address):
+        """Closes a dialing socket that did not connect and schedules another try."""
+        del self.connecting[connection]
+        self.server.set_writable(connection, False)
+        connection.close()
+        self.dialing.append((address, time.monotonic() + RETRY_INTERVAL))
+
+    def accept(self, connection, address, hello, decoder, frames):
+        """Links a server that connected to this one and applies the events it sent with its hello.
+
+        A server whose hello does not have the federation secret is disconnected.
+        """
+        peer_id, secret = split_message(hello)
+        if self.secret is None or not hmac.compare_digest(secret.encode(), self.secret.encode()):
+            server_log.warning('Refused a peer at {0} without the federation secret', address)
+            connection.close()
+            return
+        connection.sendall(encode_frame('peer', self.server_id))
+        link = PeerLink(self, connection, address, peer_id, decoder=decoder)
+        self.add_link(link)
+        for tag, message in frames:
+            self.process(link, tag, message)
+
+    def add_link(self, link):
+        """Starts relaying through a new link and tells the peer about every known user and their channels."""
+        link.connection.setblocking(False)
+        self.links[link.connection] = link
+        self.server.watch(link.connection)
+        server_log.info('Linked to peer at {0}', link.address)
+        for user in list(self.server.sessions.by_name.values()):
+            if isinstance(user, RemoteUser):
+                if user.link is link:
+                    continue
+                origin = user.origin
+            else:
+                origin = self.server_id
+            self.forward(link, 'join', self.next_event(), '{0} {1}'.format(user.name, origin))
+            for channel in user.channels:
+                self.forward(link, 'channel_join', self.next_event(), '{0} {1} {2}'.format(channel, user.name, origin))
+
+    def drop_link(self, link):
+        """Forgets a peer and every user that was reached through it."""
+        del self.links[link.connection]
+        self.dirty.discard(link)
+        self.server.set_writable(link.connection, False)
+        self.server.unwatch(link.connection)
+        link.connection.close()
+        server_log.info('Lost peer at {0}', link.address)
+        for user in [x for x in self.server.sessions.by_name.values() if isinstance(x, RemoteUser) and x.link is link]:
+            self.server.remote_leave(user)
+            self.publish('leave', '{0} {1}'.format(user.name, user.origin))
+        if link.dialed:
+            self.dialing.append((link.address, time.monotonic() + RETRY_INTERVAL))
+
+    def close(self):
+        """Closes every peer link."""
+        for link in self.links.values():
+            link.connection.close()
+        self.links.clear()
+        for connection in self.connecting:
+            connection.close()
+        self.connecting.clear()
+
+    def publish(self, tag, message):
+        """Sends a new event to every peer."""
+        event = self.next_event()
+        self.mark_seen(event)
+        for link in self.links.values():
+            self.forward(link, tag, event, message)
+
+    def forward(self, link, tag, event, message):
+        """Queues an event for a peer, it is written with the rest of the batch."""
+        if not link.outbox.append(encode_frame(tag, '{0} {1}'.format(event, message))):
+            server_log.warning('Peer at {0} is not keeping up, dropping an event', link.address)
+        self.dirty.add(link)
+
+    def flush(self):
+        """Writes the events queued for the peers during this batch."""
+        dirty, self.dirty = self.dirty, set()
+        for link in dirty:
+            self.server.handle_writable(link.connection)
+
+    def read(self, connection):
+        """Reads the events sent by a peer."""
+        link = self.links[connection]
+        try:
+            data = connection.recv(2 ** 16)
+            frames = link.decoder.feed(data) if data else None
+        except (OSError, ProtocolError, UnicodeDecodeError):
+            frames = None
+        if frames is None:
+            self.drop_link(link)
+            return
+        for tag, message in frames:
+            self.process(link, tag, message)
+
+    def process(self, link, tag, message):
+        """Applies an event from a peer and passes it on to the other peers."""
+        if tag == 'peer':
+            link.peer_id = message
+            return
+        event, message = split_message(message)
+        if not self.mark_seen(event):
+            return
+        server = self.server
+        forward = True
+        if tag == 'join':
+            name, origin = split_message(message)
+            forward = self.remote_join(link, name, origin)
+        elif tag == 'leave':
+            name, origin = split_message(message)
+            user = server.sessions.find(name)
+            forward = isinstance(user, RemoteUser) and user.origin == origin
+            if forward:
+                server.remote_leave(user)
+        elif tag == 'message':
+            server.deliver('message', message)
+        elif tag == 'channel':
+            server.deliver_channel(message)
+        elif tag in ('channel_join', 'channel_leave'):
+            channel, rest = split_message(message)
+            name, origin = split_message(rest)
+            user = server.sessions.find(name)
+            forward = isinstance(user, RemoteUser) and user.origin == origin
+            if forward:
+                server.remote_channel(user, channel, tag == 'channel_join')
+        elif tag == 'whisper':
+            target, rest = split_message(message)
+            user = server.sessions.find(target)
+            if isinstance(user, RemoteUser) and user.link is not link:
+                self.forward(user.link, tag, event, message)
+            elif isinstance(user, Session):
+                server.deliver_whisper(user, rest)
+            forward = False
+        if forward:
+            for other in self.links.values():
+                if other is not link:
+                    self.forward(other, tag, event, message)
+
+    def remote_join(self, link, name, origin):
+        """Adds a user from another server, settling a clash over the name.
+
+        Returns True if the join changed anything and should be passed on.
+        """
+        server = self.server
+        user = server.sessions.find(name)
+        if user is None:
+            server.remote_join(RemoteUser(name, link, origin))
+            return True
+        if isinstance(user, RemoteUser):
+            if origin >= user.origin:
+                return False
+            # The other server's claim wins, its user is not in the channels of the one it replaces
+            server.sessions.remove(user)
+            server.leave_channels(user)
+            server.sessions.add(RemoteUser(name, link, origin))
+            return True
+        if origin >= self.server_id:
+            return False
+        server_log.info('Username {0} was also taken on {1}', name, origin)
+        server.evict(user, 'name_taken ' + name)
+        server.remote_join(RemoteUser(name, link, origin))
+        return True
+
+
+def parse_address(address):
+    """Parses host:port into the tuple socket functions take."""
+    host, sep, port = address.rpartition(':')
+    return host or 'localhost', int(port)
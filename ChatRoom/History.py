@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_right
+from collections import deque
+
+HISTORY_SIZE = 1000
+SEGMENT_SIZE = 2 ** 24
+MAX_SEGMENTS = 16
+RECORD = struct.Struct('!QI')  # sequence number, payload length
+
+
+class LogSegment:
+    """One preallocated, memory-mapped file of the history log."""
+    def __init__(self, path, base_seq, size=SEGMENT_SIZE):
+        self.path = path
+        self.base_seq = base_seq
+        self.offsets = array('Q')
+        self.file = open(path, 'a+b')
+        if os.path.getsize(path) < size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.position = 0
+        self.scan()
+
+    def scan(self):
+        """Rebuilds the offset index from the records already in the file."""
+        while self.position + RECORD.size <= len(self.map):
+            seq, length = RECORD.unpack_from(self.map, self.position)
+            if length == 0 or seq != self.base_seq + len(self.offsets):
+                break
+            self.offsets.append(self.position)
+            self.position += RECORD.size + length
+
+    def next_seq(self):
+        """Returns the sequence number the next record in this segment gets."""
+        return self.base_seq + len(self.offsets)
+
+    def append(self, payload):
+        """Appends a record, returns False if the segment has no room left."""
+        end = self.position + RECORD.size + len(payload)
+        if end > len(self.map):
+            return False
+        RECORD.pack_into(self.map, self.position, self.next_seq(), len(payload))
+        self.map[self.position + RECORD.size:end] = payload
+        self.offsets.append(self.position)
+        self.position = end
+        return True
+
+    def read(self, seq):
+        """Returns the payload of a record in this segment."""
+        offset = self.offsets[seq - self.base_seq]
+        seq, length = RECORD.unpack_from(self.map, offset)
+        return self.map[offset + RECORD.size:offset + RECORD.size + length]
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class HistoryLog:
+    """Append-only log of messages split into memory-mapped segment files.
+
+    Each segment keeps the offset of its records, so finding a sequence
+    number is a search over the segments and one array lookup. Only the
+    newest max_segments segments are kept on disk.
+    """
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, max_segments=MAX_SEGMENTS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.segments = []
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log'):
+                base_seq = int(name[:-4])
+                self.segments.append(LogSegment(os.path.join(directory, name), base_seq, segment_size))
+        if not self.segments:
+            self.add_segment(1)
+
+    def add_segment(self, base_seq):
+        """Starts a new segment, deleting the oldest ones past max_segments."""
+        path = os.path.join(self.directory, '{0:020d}.log'.format(base_seq))
+        self.segments.append(LogSegment(path, base_seq, self.segment_size))
+        while len(self.segments) > self.max_segments:
+            segment = self.segments.pop(0)
+            segment.close()
+            os.remove(segment.path)
+
+    def next_seq(self):
+        """Returns the sequence number the next record gets."""
+        return self.segments[-1].next_seq()
+
+    def first_seq(self):
+        """Returns the oldest sequence number still in the log."""
+        return self.segments[0].base_seq
+
+    def append(self, payload):
+        """Appends a record and returns its sequence number."""
+        seq = self.next_seq()
+        if not self.segments[-1].append(payload):
+            self.add_segment(seq)
+            if not self.segments[-1].append(payload):
+                raise ValueError('Record of {0} bytes is larger than a segment'.format(len(payload)))
+        return seq
+
+    def read(self, seq):
+        """Returns the payload of a record, or None if it is no longer in the log."""
+        if seq < self.first_seq() or seq >= self.next_seq():
+            return None
+        index = bisect_right([x.base_seq for x in self.segments], seq) - 1
+        return self.segments[index].read(seq)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class HistoryStore:
+    """Recent messages in a bounded ring, backed by an optional on-disk log.
+
+    Records are (sequence number, tag, body). Replays read one record at a
+    time with get, so a long replay is never held in memory.
+    """
+    def __init__(self, size=HISTORY_SIZE, directory=None):
+        self.ring = deque(maxlen=size)
+        self.log = HistoryLog(directory) if directory else None
+        self.next_seq = self.log.next_seq() if self.log else 1
+
+    def append(self, tag, body):
+        """Records a message and returns its sequence number."""
+        if self.log is not None:
+            seq = self.log.append('{0} {1}'.format(tag, body).encode())
+        else:
+            seq = self.next_seq
+        self.ring.append((seq, tag, body))
+        self.next_seq = seq + 1
+        return seq
+
+    def first_seq(self):
+        """Returns the oldest sequence number that can still be replayed."""
+        if self.log is not None:
+            return self.log.first_seq()
+        return self.ring[0][0] if self.ring else self.next_seq
+
+    def get(self, seq):
+        """Returns the record with a sequence number, or None if it is gone."""
+        if self.ring and seq >= self.ring[0][0]:
+            return self.ring[seq - self.ring[0][0]]
+        if self.log is not None:
+            payload = self.log.read(seq)
+            if payload is not None:
+                tag, sep, body = payload.decode().partition(' ')
+                return seq, tag, body
+        return None
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
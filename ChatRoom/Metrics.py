@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+import os
+import socketserver
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+TIME_BUCKETS = (.00001, .00005, .0001, .0005, .001, .005, .01, .05, .1, .5, 1)
+DEPTH_BUCKETS = (0, 2 ** 10, 2 ** 12, 2 ** 14, 2 ** 16, 2 ** 18, 2 ** 20)
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, with their sum."""
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q quantile, None if it is past the last bound."""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return None
+
+    def exposition(self, name):
+        """Returns the histogram's lines in the text exposition format."""
+        lines = ['# TYPE {0} histogram'.format(name)]
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(name, bound, total))
+        lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(name, self.count))
+        lines.append('{0}_sum {1}'.format(name, self.sum))
+        lines.append('{0}_count {1}'.format(name, self.count))
+        return lines
+
+
+class Metrics:
+    """Counters and histograms describing a running server.
+
+    The server only records into a Metrics object when it was given one, so
+    without it the instrumentation costs a check against None. The values are
+    written by the server loop and read by other threads as they are, without
+    locking, so a report may be off by the events of the current batch.
+    """
+    def __init__(self, port=None, path=None):
+        self.port = port
+        self.path = path
+        self.endpoint = None
+        self.server = None
+        self.started = time.monotonic()
+        self.messages_in = {}
+        self.messages_out = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.accepts = 0
+        self.rejects = 0
+        self.limited = {}
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.loop_time = Histogram(TIME_BUCKETS)
+
+    def attach(self, server):
+        """Starts reporting on the given server, serving the report if a port or path was given."""
+        self.server = server
+        if self.port is not None:
+            self.endpoint = HTTPServer(('localhost', self.port), MetricsHTTPHandler)
+        elif self.path is not None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.endpoint = socketserver.UnixStreamServer(self.path, MetricsStreamHandler)
+        if self.endpoint is not None:
+            self.endpoint.metrics = self
+            threading.Thread(target=self.endpoint.serve_forever, daemon=True).start()
+
+    def close(self):
+        """Stops serving the report."""
+        if self.endpoint is not None:
+            self.endpoint.shutdown()
+            self.endpoint.server_close()
+            self.endpoint = None
+            if self.path is not None:
+                os.remove(self.path)
+
+    def message_in(self, tag):
+        """Records a message read from a user."""
+        self.messages_in[tag] = self.messages_in.get(tag, 0) + 1
+
+    def message_out(self, tag, recipients):
+        """Records a message sent to a number of recipients."""
+        self.messages_out[tag] = self.messages_out.get(tag, 0) + recipients
+        self.fanout.observe(recipients)
+
+    def rate_limited(self, tag):
+        """Records a message from a user that was over its rate limit."""
+        self.limited[tag] = self.limited.get(tag, 0) + 1
+
+    def queue_depths(self):
+        """Returns a histogram of the bytes queued for each local user right now."""
+        depths = Histogram(DEPTH_BUCKETS)
+        for session in list(self.server.sessions.by_socket.values()):
+            depths.observe(len(session.outbox) if session.outbox is not None else 0)
+        return depths
+
+    def exposition(self):
+        """Returns the report in the text exposition format."""
+        server = self.server
+        lines = ['# TYPE chat_messages_in_total counter']
+        for tag, count in sorted(self.messages_in.items()):
+            lines.append('chat_messages_in_total{{tag="{0}"}} {1}'.format(tag, count))
+        lines.append('# TYPE chat_messages_out_total counter')
+        for tag, count in sorted(self.messages_out.items()):
+            lines.append('chat_messages_out_total{{tag="{0}"}} {1}'.format(tag, count))
+        lines.append('# TYPE chat_rate_limited_total counter')
+        for tag, count in sorted(self.limited.items()):
+            lines.append('chat_rate_limited_total{{tag="{0}"}} {1}'.format(tag, count))
+        lines.append('# TYPE chat_bytes_in_total counter')
+        lines.append('chat_bytes_in_total {0}'.format(self.bytes_in))
+        lines.append('# TYPE chat_bytes_out_total counter')
+        lines.append('chat_bytes_out_total {0}'.format(self.bytes_out))
+        lines.append('# TYPE chat_accepts_total counter')
+        lines.append('chat_accepts_total {0}'.format(self.accepts))
+        lines.append('# TYPE chat_rejects_total counter')
+        lines.append('chat_rejects_total {0}'.format(self.rejects))
+        lines.append('# TYPE chat_connections gauge')
+        lines.append('chat_connections {0}'.format(len(server.sessions)))
+        lines.append('# TYPE chat_users gauge')
+        lines.append('chat_users {0}'.format(server.sessions.roster_size()))
+        memory = server.memory_report()
+        if memory['resident'] is not None:
+            lines.append('# TYPE chat_resident_bytes gauge')
+            lines.append('chat_resident_bytes {0}'.format(memory['resident']))
+        lines.append('# TYPE chat_session_bytes gauge')
+        lines.append('chat_session_bytes {0}'.format(memory['sessions']))
+        lines.append('# TYPE chat_deflate_streams gauge')
+        lines.append('chat_deflate_streams {0}'.format(memory['deflaters']))
+        lines.extend(self.fanout.exposition('chat_fanout'))
+        lines.extend(self.loop_time.exposition('chat_loop_seconds'))
+        lines.extend(self.queue_depths().exposition('chat_queue_depth_bytes'))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Returns a short human readable report."""
+        uptime = time.monotonic() - self.started
+        depths = self.queue_depths()
+        memory = self.server.memory_report()
+        lines = [
+            'Uptime {0:.0f}s, {1} connections, {2} users'.format(
+                uptime, len(self.server.sessions), self.server.sessions.roster_size()),
+            'Accepted {0} ({1:.2f}/s), rejected {2}'.format(self.accepts, self.accepts / uptime, self.rejects),
+            'Bytes in {0}, bytes out {1}'.format(self.bytes_in, self.bytes_out),
+            'Messages in: ' + (', '.join('{0} {1}'.format(k, v) for k, v in sorted(self.messages_in.items())) or
+                               'none'),
+            'Messages out: ' + (', '.join('{0} {1}'.format(k, v) for k, v in sorted(self.messages_out.items())) or
+                                'none'),
+            'Rate limited: ' + (', '.join('{0} {1}'.format(k, v) for k, v in sorted(self.limited.items())) or
+                                'none'),
+            'Fanout p50 {0} p99 {1}'.format(self.fanout.quantile(.5), self.fanout.quantile(.99)),
+            'Loop time p50 {0}s p99 {1}s'.format(self.loop_time.quantile(.5), self.loop_time.quantile(.99)),
+            'Queue depth p50 {0} p99 {1} bytes'.format(depths.quantile(.5), depths.quantile(.99)),
+            'Memory {0} kB resident, {1} bytes in sessions, {2} deflate streams'.format(
+                memory['resident'] // 1024 if memory['resident'] is not None else '?', memory['sessions'],
+                memory['deflaters']),
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHTTPHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the metrics report."""
+    def do_GET(self):
+        body = self.server.metrics.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsStreamHandler(socketserver.StreamRequestHandler):
+    """Writes the metrics report to each Unix socket connection and closes it."""
+    def handle(self):
+        self.wfile.write(self.server.metrics.exposition().encode())
+
+
+def resident_memory():
+    """Returns the bytes of memory the process has resident, or None outside Linux."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return None
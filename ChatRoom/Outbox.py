@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import os
+import time
+from collections import deque
+from itertools import islice
+
+HIGH_WATER = 2 ** 18
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class Outbox:
+    """Bounded queue of data waiting to be written to one connection.
+
+    The queue remembers when it went over its high-water mark so the server
+    can disconnect clients that stay behind for too long. The queue never holds
+    more than limit bytes, four times the high-water mark by default. The
+    deque of chunks only exists while something is queued, so an idle
+    connection's outbox is a handful of numbers.
+    """
+    __slots__ = ('chunks', 'size', 'high_water', 'limit', 'over_since', 'overflowed')
+
+    def __init__(self, high_water=HIGH_WATER, limit=None):
+        self.chunks = None
+        self.size = 0
+        self.high_water = high_water
+        self.limit = limit or 4 * high_water
+        self.over_since = None
+        self.overflowed = False
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        """Queues data, returns False and drops it if the queue is full."""
+        if self.size + len(data) > self.limit:
+            self.overflowed = True
+            return False
+        if self.chunks is None:
+            self.chunks = deque()
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.over_since is None and self.size > self.high_water:
+            self.over_since = time.monotonic()
+        return True
+
+    def flush(self, connection):
+        """Writes as much queued data as the socket accepts without blocking.
+
+        Queued chunks are written together with one sendmsg call where the
+        socket supports it. Returns the number of bytes still queued.
+        """
+        vectored = hasattr(connection, 'sendmsg')
+        while self.chunks:
+            try:
+                if vectored and len(self.chunks) > 1:
+                    sent = connection.sendmsg(islice(self.chunks, IOV_MAX))
+                else:
+                    sent = connection.send(self.chunks[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            if not sent:
+                break
+            self.size -= sent
+            while sent:
+                chunk = self.chunks[0]
+                if sent < len(chunk):
+                    self.chunks[0] = memoryview(chunk)[sent:]
+                    break
+                sent -= len(chunk)
+                self.chunks.popleft()
+            else:
+                continue
+            # The socket took part of a chunk, it is full
+            break
+        if not self.size:
+            self.chunks = None
+        if self.size <= self.high_water:
+            self.over_since = None
+        return self.size
+
+    def over_high_water(self):
+        """Checks if the queue is currently above its high-water mark."""
+        return self.over_since is not None
+
+    def stalled(self, now, timeout):
+        """Checks if the queue overflowed or stayed above its high-water mark for timeout seconds."""
+        return self.overflowed or (self.over_since is not None and now - self.over_since > timeout)
+
+    def drop_queued(self):
+        """Drops the queued data but the rest of a chunk already partly written, what follows starts a frame."""
+        partial = self.chunks[0] if self.chunks and isinstance(self.chunks[0], memoryview) else None
+        self.clear()
+        if partial is not None:
+            self.chunks = deque([partial])
+            self.size = len(partial)
+
+    def clear(self):
+        """Drops all queued data."""
+        self.chunks = None
+        self.size = 0
+        self.over_since = None
@@ -1,13 +1,111 @@
 import sys
+import threading
+import time
 import readline
+from collections import deque
+
+RENDER_INTERVAL = .03
+MAX_BACKLOG = 500
+KEEP_LINES = 50
 
 
 def post_message(prompt, message, from_cmd=False):
     """Post a message to the commandline without interfering with the typed commands"""
-    temp = readline.get_line_buffer()
-    sys.stdout.write('\r' + ' ' * (len(temp) + len(prompt)) + '\r')
-    sys.stdout.write(message)
+    if renderer.interval is not None:
+        renderer.post(prompt, message, from_cmd)
+    else:
+        write_message(prompt, message, from_cmd)
 
+
+def write_message(prompt, message, from_cmd=False):
+    """Writes a message over the typed command and redraws it, all in one write."""
+    temp = readline.get_line_buffer()
+    text = '\r' + ' ' * (len(temp) + len(prompt)) + '\r' + message
     if not from_cmd:
-        sys.stdout.write(prompt + temp)
+        text += prompt + temp
+    sys.stdout.write(text)
     sys.stdout.flush()
+
+
+class Renderer:
+    """Draws the messages posted from other threads in batches, at most once every interval seconds.
+
+    Posting only queues the message, the render thread then writes every
+    message queued since its last draw and redraws the prompt and typed
+    command once for all of them. If more than max_backlog messages pile up
+    between two draws, only the last keep are drawn, after a line saying how
+    many were left out. Messages posted from the command loop are drawn at
+    once, after whatever was queued before them. Until configure is called
+    with an interval, post_message writes every message straight away.
+    """
+    def __init__(self, interval=None, max_backlog=MAX_BACKLOG, keep=KEEP_LINES):
+        self.interval = interval
+        self.max_backlog = max_backlog
+        self.keep = keep
+        self.pending = deque()
+        self.prompt = ''
+        self.skipped = 0
+        self.drawn = 0
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def configure(self, interval=RENDER_INTERVAL, max_backlog=MAX_BACKLOG, keep=KEEP_LINES):
+        """Starts drawing in batches, or writing every message straight away again if interval is None."""
+        self.flush()
+        self.interval = interval
+        self.max_backlog = max_backlog
+        self.keep = min(keep, max_backlog)
+
+    def post(self, prompt, message, from_cmd=False):
+        if from_cmd:
+            self.draw(prompt, message, True)
+            return
+        self.prompt = prompt
+        self.pending.append(message)
+        if len(self.pending) > self.max_backlog:
+            with self.lock:
+                while len(self.pending) > self.keep:
+                    self.pending.popleft()
+                    self.skipped += 1
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.render_loop, daemon=True)
+            self.thread.start()
+        self.wake.set()
+
+    def render_loop(self):
+        """Draws the queued messages, waiting out the rest of the interval after each draw, run by the render thread."""
+        while True:
+            self.wake.wait()
+            delay = self.drawn + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.wake.clear()
+            self.draw(self.prompt, '', False)
+
+    def draw(self, prompt, message, from_cmd):
+        """Writes every queued message and then message in one go."""
+        with self.lock:
+            messages = []
+            try:
+                while True:
+                    messages.append(self.pending.popleft())
+            except IndexError:
+                pass
+            if self.skipped:
+                messages.insert(0, '... {0} messages not shown, use "\\history" to see them ...\n'.format(
+                    self.skipped))
+                self.skipped = 0
+            messages.append(message)
+            text = ''.join(messages)
+            if text or from_cmd:
+                write_message(prompt, text, from_cmd)
+            self.drawn = time.monotonic()
+
+    def flush(self):
+        """Draws the queued messages from the calling thread."""
+        if self.pending or self.skipped:
+            self.draw(self.prompt, '', False)
+
+
+renderer = Renderer()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+PRESENCE_WINDOW = .05
+DELTA = 'delta'
+EVENTS = 'events'
+
+
+class PresenceBatch:
+    """Joins and leaves gathered over a short window, sent together when it ends.
+
+    Each name keeps only its latest change, a user that joins and leaves
+    within the same window cancels out and is never announced.
+    """
+    def __init__(self):
+        self.changes = {}
+
+    def __len__(self):
+        return len(self.changes)
+
+    def change(self, name, joined):
+        """Records that a user joined or left, returns True if it is the first change of the window."""
+        first = not self.changes
+        if self.changes.get(name) is (not joined):
+            del self.changes[name]
+        else:
+            self.changes[name] = joined
+        return first
+
+    def take(self):
+        """Returns the changes of the window as (name, joined) pairs and starts a new one."""
+        changes, self.changes = self.changes, {}
+        return list(changes.items())
+
+
+def encode_delta(changes):
+    """Encodes (name, joined) pairs as the body of a presence frame, +name for a join and -name for a leave."""
+    return ' '.join(('+' if joined else '-') + name for name, joined in changes)
+
+
+def decode_delta(message):
+    """Returns the names joined and left in the body of a presence frame."""
+    joined = []
+    left = []
+    for entry in message.split():
+        if entry[0] == '+':
+            joined.append(entry[1:])
+        elif entry[0] == '-':
+            left.append(entry[1:])
+        else:
+            raise ValueError('Bad presence entry {0}'.format(entry))
+    return joined, left
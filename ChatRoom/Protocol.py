@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import struct
+import zlib
+
+PROTOCOL_VERSION = 2
+HEADER = struct.Struct('!IB')  # payload length, flags
+MAX_FRAME = 2 ** 20
+FLAG_DEFLATE = 1
+COMPRESSION = 'deflate'
+COMPRESS_THRESHOLD = 512
+DEFLATER_MEMORY = 2 ** 18  # what zlib allocates for a stream with the default window and memory level
+PRESENCE = 'presence'
+NO_PRESENCE = 'nopresence'
+RESUME = 'resume'
+SEQUENCED_TAGS = ('message', 'whisper', 'channel')
+
+
+class ProtocolError(ValueError):
+    """Raised when a peer sends data that is not a valid frame."""
+    pass
+
+
+class FrameDecoder:
+    """Buffers the bytes read from one connection and returns the complete frames.
+
+    A frame is a header holding the payload length and flags, followed by the
+    payload, which is the tag and body of the message as UTF-8. Payloads with
+    the deflate flag are inflated with one stream kept for the whole
+    connection, if the decoder was made with inflate set.
+
+    Whole frames are parsed straight from the data read, the buffer only
+    holds the start of a frame that has not all arrived yet and is empty,
+    taking no memory, between frames.
+    """
+    __slots__ = ('buffer', 'max_frame', 'inflater')
+
+    def __init__(self, max_frame=MAX_FRAME, inflate=False):
+        self.buffer = b''
+        self.max_frame = max_frame
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS) if inflate else None
+
+    def feed(self, data):
+        """Adds newly read data and returns a list of (tag, body) for each whole frame."""
+        if self.buffer:
+            self.buffer += data
+            data = self.buffer
+        frames = []
+        offset = 0
+        view = memoryview(data)
+        while len(data) - offset >= HEADER.size:
+            length, flags = HEADER.unpack_from(data, offset)
+            if length > self.max_frame:
+                view.release()
+                raise ProtocolError('Frame of {0} bytes is too large'.format(length))
+            end = offset + HEADER.size + length
+            if end > len(data):
+                break
+            payload = bytes(view[offset + HEADER.size:end])
+            if flags & FLAG_DEFLATE:
+                try:
+                    payload = self.inflate(payload)
+                except ProtocolError:
+                    view.release()
+                    raise
+            frames.append(split_message(payload.decode()))
+            offset = end
+        view.release()
+        if offset == len(data):
+            self.buffer = b''
+        elif data is not self.buffer:
+            self.buffer = bytearray(data[offset:])
+        elif offset:
+            del self.buffer[:offset]
+        return frames
+
+    def inflate(self, payload):
+        """Inflates a compressed payload, refusing any that would be larger than a frame."""
+        if self.inflater is None:
+            raise ProtocolError('Compressed frame on a connection without compression')
+        try:
+            data = self.inflater.decompress(payload, self.max_frame)
+        except zlib.error as e:
+            raise ProtocolError('Bad compressed frame: {0}'.format(e))
+        if self.inflater.unconsumed_tail:
+            raise ProtocolError('Compressed frame is too large')
+        return data
+
+
+class FrameCompressor:
+    """Compresses the large frames sent on one connection.
+
+    One deflate stream is kept for the whole connection, so each frame is
+    compressed with what came before it as the dictionary. Frames under the
+    threshold are sent as they are, they gain little and would cost CPU. The
+    stream takes a few hundred kilobytes, so it is only made for the first
+    frame that needs it, and release lets go of it while the connection is
+    quiet.
+    """
+    __slots__ = ('deflater', 'threshold', 'level')
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=6):
+        self.deflater = None
+        self.threshold = threshold
+        self.level = level
+
+    def wants(self, frame):
+        """Checks if an encoded frame is large enough to be compressed."""
+        return len(frame) - HEADER.size >= self.threshold
+
+    def compress(self, frame):
+        """Compresses an encoded frame, flushing the stream so the peer can inflate it right away."""
+        if self.deflater is None:
+            self.deflater = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        payload = memoryview(frame)[HEADER.size:]
+        data = self.deflater.compress(payload) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        return HEADER.pack(len(data), FLAG_DEFLATE) + data
+
+    def release(self):
+        """Drops the deflate stream, the next compressed frame starts a new one.
+
+        Every frame ends on a sync flush and a new stream only refers back to
+        what it sent itself, so the peer inflates on without noticing.
+        """
+        self.deflater = None
+
+
+def is_frame(data):
+    """Checks if the first bytes from a peer start a frame rather than a legacy message."""
+    return data[:1] == b'\x00'
+
+
+def encode_frame(tag, body=''):
+    """Encodes a tag and body as a frame."""
+    payload = '{0} {1}'.format(tag, body).encode() if body else tag.encode()
+    return HEADER.pack(len(payload), 0) + payload
+
+
+def encode_cursor(name):
+    """Encodes the last name of a roster page as the opaque cursor the client sends back."""
+    return name.encode().hex()
+
+
+def decode_cursor(cursor):
+    """Decodes a roster cursor, - is the start of the roster. Raises ValueError if the cursor is not valid."""
+    if cursor == '-':
+        return None
+    try:
+        return bytes.fromhex(cursor).decode()
+    except UnicodeDecodeError:
+        raise ValueError('Bad cursor {0}'.format(cursor))
+
+
+def encode_legacy(tag, body=''):
+    """Encodes a tag and body for peers speaking the unframed protocol."""
+    return '{0} {1}'.format(tag, body).encode() if body else tag.encode()
+
+
+def split_message(message):
+    """Splits a message into its tag and the body of the message"""
+    split = message.strip().split(sep=None, maxsplit=1)
+    if len(split) == 0:
+        return '', ''
+    elif len(split) == 1:
+        return split[0], ''
+    else:
+        return split[0], split[1]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import time
+
+MESSAGE_RATE = 50
+MESSAGE_BURST = 100
+DELAY = 'delay'
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+POLICIES = (DELAY, DROP, DISCONNECT)
+FANOUT_TAGS = ('message', 'channel')
+
+
+class TokenBucket:
+    """Allows rate events per second on average and up to burst at once.
+
+    A cost larger than the burst is let through once the bucket is full and
+    leaves it in debt, so big events are slowed down instead of never passing.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait(self, now, cost=1):
+        """Returns the seconds until cost tokens can be taken, 0 if they can be now."""
+        self.refill(now)
+        needed = min(cost, self.burst)
+        if self.tokens < needed:
+            return (needed - self.tokens) / self.rate
+        return 0
+
+
+class RateLimits:
+    """How fast each connection may send, and what happens when it sends faster.
+
+    Every connection has a bucket for everything it sends and one for each
+    tag given a limit of its own, created the first time they are needed.
+    The fanout budget is shared by the whole server and charged one token per
+    recipient of a message or channel message, so a few senders can not take
+    all the delivery capacity. Over the limit, the delay policy stops reading
+    from the connection until it may send again and leaves the rest to TCP
+    flow control, drop discards the message with a rate_limited error and
+    disconnect evicts the client.
+    """
+    def __init__(self, rate=MESSAGE_RATE, burst=MESSAGE_BURST, tags=None, policy=DELAY, fanout=None,
+                 fanout_burst=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown rate limit policy {0}'.format(policy))
+        self.rate = rate
+        self.burst = burst
+        self.tags = tags or {}
+        self.policy = policy
+        self.fanout = None
+        if fanout:
+            self.fanout = TokenBucket(fanout, fanout_burst or fanout)
+
+    def check(self, session, tag, now, recipients=0):
+        """Charges a message to its sender's buckets, returns 0 if it may go or else the seconds to wait.
+
+        Nothing is charged for a message that has to wait.
+        """
+        buckets = session.buckets
+        if buckets is None:
+            buckets = session.buckets = {None: TokenBucket(self.rate, self.burst, now)}
+        connection = buckets[None]
+        wait = connection.wait(now)
+        bucket = None
+        limit = self.tags.get(tag)
+        if limit is not None:
+            bucket = buckets.get(tag)
+            if bucket is None:
+                bucket = buckets[tag] = TokenBucket(limit[0], limit[1], now)
+            wait = max(wait, bucket.wait(now))
+        fanout = self.fanout if recipients else None
+        if fanout is not None:
+            wait = max(wait, fanout.wait(now, recipients))
+        if wait:
+            return wait
+        connection.tokens -= 1
+        if bucket is not None:
+            bucket.tokens -= 1
+        if fanout is not None:
+            fanout.tokens -= recipients
+        return 0
+
+
+def parse_limit(text):
+    """Parses a tag=rate[:burst] limit into (tag, (rate, burst)), the burst defaults to twice the rate."""
+    tag, sep, limit = text.partition('=')
+    rate, sep, burst = limit.partition(':')
+    if not tag or not rate:
+        raise ValueError('Expected tag=rate[:burst], got {0}'.format(text))
+    rate = float(rate)
+    return tag, (rate, float(burst) if burst else 2 * rate)
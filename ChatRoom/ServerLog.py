@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import os
+import threading
+import time
+from collections import deque
+from .PostMessage import *
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {v: k.upper() for k, v in LEVELS.items()}
+MAX_PENDING = 2 ** 16
+MAX_LOG_BYTES = 2 ** 22
+LOG_BACKUPS = 3
+
+
+class ServerLog:
+    """Server log whose records are written by a background thread.
+
+    Logging only formats the record and queues it, the writer thread takes
+    every record queued since its last write and writes them together, to the
+    console through post_message or to a file that is rotated when it grows
+    past max_bytes. Records under the level are dropped before formatting.
+    """
+    def __init__(self, level=INFO, path=None, max_bytes=MAX_LOG_BYTES, backups=LOG_BACKUPS):
+        self.level = level
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.reset()
+
+    def reset(self):
+        """Forgets the writer thread and queued records, a forked process starts its own writer."""
+        self.pending = deque()
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+        self.file = None
+
+    def configure(self, level=None, path=None):
+        """Changes the level and the file written to, the console is used if path is None."""
+        if level is not None:
+            self.level = level
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.path = path
+
+    def log(self, level, message, *args):
+        """Queues a record, formatting the message with args if it is written."""
+        if level < self.level:
+            return
+        if len(self.pending) >= MAX_PENDING:
+            self.dropped += 1
+            return
+        if args:
+            message = message.format(*args)
+        self.pending.append((time.time(), level, message))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write_loop, daemon=True)
+            self.thread.start()
+        self.wake.set()
+
+    def debug(self, message, *args):
+        self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        self.log(INFO, message, *args)
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+    def write_loop(self):
+        """Writes the queued records in batches, run by the writer thread."""
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            self.write_pending()
+
+    def write_pending(self):
+        """Writes every record queued so far in one go."""
+        with self.lock:
+            self.write_records()
+
+    def write_records(self):
+        records = []
+        try:
+            while True:
+                records.append(self.pending.popleft())
+        except IndexError:
+            pass
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append((time.time(), WARNING, 'Dropped {0} log records'.format(dropped)))
+        if not records:
+            return
+        if self.path is None:
+            post_message('> ', ''.join(x[2] + '\n' for x in records))
+        else:
+            self.write_file(''.join('{0} {1} {2}\n'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp)), LEVEL_NAMES[level], message)
+                for stamp, level, message in records))
+
+    def write_file(self, text):
+        """Appends text to the log file, rotating it first if it is full."""
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        if self.file.tell() + len(text) > self.max_bytes and self.file.tell() > 0:
+            self.file.close()
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists('{0}.{1}'.format(self.path, i)):
+                    os.replace('{0}.{1}'.format(self.path, i), '{0}.{1}'.format(self.path, i + 1))
+            if self.backups:
+                os.replace(self.path, self.path + '.1')
+            else:
+                os.remove(self.path)
+            self.file = open(self.path, 'a')
+        self.file.write(text)
+        self.file.flush()
+
+    def flush(self):
+        """Writes the queued records from the calling thread."""
+        if self.thread is not None or self.pending:
+            self.write_pending()
+
+    def close(self):
+        """Writes what is still queued and closes the log file."""
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+server_log = ServerLog()
+os.register_at_fork(after_in_child=server_log.reset)
@@ -1,135 +1,1193 @@
 #!/usr/bin/env python3
+import asyncio
+import resource
+import secrets
 import select
-from .PostMessage import *
+import time
+from .ServerLog import *
+from .Protocol import *
+from .Outbox import *
+from .Session import *
+from .Channels import *
+from .History import *
+from .Metrics import *
+from .Presence import *
+from .Streams import *
+from .RateLimit import *
+from .TimerWheel import *
+from .Upgrade import *
 from socket import *
 
+SLOW_TIMEOUT = 5
+TICK_INTERVAL = .1
+FLUSH_DELAY = 0
+HANDSHAKE_TIMEOUT = 5
+ACCEPT_BATCH = 64
+BACKLOG = 1024
+PING_INTERVAL = 30
+IDLE_TIMEOUT = 75
+RESUME_WINDOW = 120
+FD_SETSIZE = 1024  # select can only watch descriptors below this
+
+
 class ChatServer:
-    def __init__(self, port):
-        self.server_sock = socket(AF_INET, SOCK_STREAM)
-        
-        self.server_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.server_sock.bind(('', port))
+    max_fd = FD_SETSIZE
+
+    def __init__(self, port, high_water=HIGH_WATER, slow_timeout=SLOW_TIMEOUT, reuse_port=False, shard=None,
+                 federation=None, history_size=HISTORY_SIZE, history_dir=None, metrics=None, flush_delay=FLUSH_DELAY,
+                 compress_threshold=COMPRESS_THRESHOLD, backlog=BACKLOG, handshake_timeout=HANDSHAKE_TIMEOUT,
+                 presence_window=PRESENCE_WINDOW, limits=None, ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 resume_window=RESUME_WINDOW, listener=None):
+        if listener is not None:
+            # Handed over by the server this one replaces, already bound and listening
+            self.server_sock = listener
+        else:
+            self.server_sock = socket(AF_INET, SOCK_STREAM)
+
+            self.server_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            if reuse_port:
+                self.server_sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            self.server_sock.bind(('', port))
 
-        self.server_sock.listen(5)
-        self.ACTIVE_SOCKETS = {self.server_sock: 'Server'}
-        post_message('> ', 'Server started on port {0}\n'.format(port))
+            self.server_sock.listen(backlog)
+        self.server_sock.setblocking(False)
+        self.sessions = SessionRegistry()
+        self.channels = ChannelIndex()
+        self.history = HistoryStore(history_size, history_dir)
+        self.WRITERS = set()
+        self.SLOW = set()
+        self.PENDING = set()
+        self.HANDSHAKES = {}
+        self.THROTTLED = {}
+        self.LINGERING = {}
+        self.limits = limits
+        self.timers = TimerWheel()
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.RESUMABLE = {}
+        self.resume_window = resume_window
+        self.handshake_timeout = handshake_timeout
+        self.flush_delay = flush_delay
+        self.flush_at = None
+        self.presence = PresenceBatch()
+        self.presence_window = presence_window
+        self.presence_at = None
+        self.compress_threshold = compress_threshold
+        self.high_water = high_water
+        self.slow_timeout = slow_timeout
+        self.shard = shard
+        self.federation = federation
+        self.metrics = metrics
+        self.running = False
+        self.baseline_memory = resident_memory()
+        server_log.info('Server started on port {0}', port)
+        if federation is not None:
+            federation.attach(self)
+        if metrics is not None:
+            metrics.attach(self)
+
+    def run(self):
+        """Checks the sockets until the server is stopped."""
+        self.running = True
+        while self.running:
+            self.check_sockets(.1)
+
+    def stop(self):
+        """Stops the loop started by run."""
+        self.running = False
 
     def close(self):
         """Disconnects from all connections and closes server."""
-        message = 'shutdown'
-        for connection in self.ACTIVE_SOCKETS:
-            if connection is not self.server_sock:
-                send_data(message.encode(), [connection])
-            self.disconnect(connection, suppress=True)
-
-    def check_sockets(self):
-        """Checks sockets for new messages."""
-        to_read = list(self.ACTIVE_SOCKETS)
-        
-        read, write, err = select.select(to_read, [], [], 0)
+        for session in list(self.sessions):
+            self.send('shutdown', '', [session])
+            self.disconnect(session.connection, suppress=True)
+        for connection in list(self.HANDSHAKES):
+            self.drop_handshake(connection)
+        for connection in list(self.LINGERING):
+            self.close_lingering(connection)
+        if self.federation is not None:
+            self.federation.close()
+        self.history.close()
+        if self.metrics is not None:
+            self.metrics.close()
+        self.server_sock.close()
+
+    def snapshot(self):
+        """Returns the sockets and the state a new process needs to carry on serving, for a hot upgrade.
+
+        The server must be stopped. Joins, leaves and queued data are flushed
+        first, what the sockets do not take is handed over with the rest. The
+        state refers to the sockets by their index in the list, which starts
+        with the listening socket. The metrics endpoint is closed so the new
+        process can open it, abort_upgrade opens it again.
+        """
+        if self.shard is not None or self.federation is not None:
+            raise UpgradeError('Sharded and federated servers can not be upgraded')
+        self.flush_presence()
+        self.flush_pending()
+        sockets = [self.server_sock]
+        sessions = []
+        for session in self.sessions:
+            sockets.append(session.connection)
+            sessions.append(self.session_state(session, len(sockets) - 1))
+        handshakes = []
+        for handshake in self.HANDSHAKES.values():
+            sockets.append(handshake.connection)
+            handshakes.append({
+                'socket': len(sockets) - 1,
+                'address': handshake.address,
+                'deadline': handshake.deadline,
+                'buffer': bytes(handshake.decoder.buffer) if handshake.decoder is not None else None,
+            })
+        detached = [self.session_state(x, None) for x in self.RESUMABLE.values()
+                    if self.sessions.get(x.connection) is not x]
+        if self.metrics is not None:
+            self.metrics.close()
+        state = {
+            'sessions': sessions,
+            'handshakes': handshakes,
+            'detached': detached,
+            'history': list(self.history.ring) if self.history.log is None else [],
+            'next_seq': self.history.next_seq,
+        }
+        return sockets, state
+
+    def session_state(self, session, index):
+        """Returns what a new process needs to carry on with a session, whose socket is at index.
+
+        Response streams still running are saved as their position, the new
+        process sends the rest of them.
+        """
+        return {
+            'socket': index,
+            'name': session.name,
+            'address': session.address,
+            'buffer': bytes(session.decoder.buffer) if session.decoder is not None else None,
+            'outbox': b''.join(session.outbox.chunks or ()) if session.outbox is not None else b'',
+            'compress': session.compressor is not None,
+            'presence': session.presence,
+            'channels': sorted(session.channels),
+            'sequenced': session.sequenced,
+            'token': session.token,
+            'last_seen': session.last_seen,
+            'held': session.held,
+            'stream': [x.state() for x in session.stream] if session.stream is not None else None,
+            'throttled': self.THROTTLED.get(session.connection),
+        }
+
+    def abort_upgrade(self):
+        """Undoes what snapshot did to the server after a failed upgrade, so it can run again."""
+        if self.metrics is not None:
+            self.metrics.attach(self)
+
+    def release(self):
+        """Closes this process's copies of the sockets once a new process took them over.
+
+        Nothing is sent and no socket is shut down, the connections stay open
+        in the new process.
+        """
+        for connection in list(self.sessions.sockets()) + list(self.HANDSHAKES):
+            self.set_writable(connection, False)
+            self.unwatch(connection)
+            connection.close()
+        for connection in list(self.LINGERING):
+            self.close_lingering(connection)
+        self.history.close()
+        self.server_sock.close()
+
+    def restore(self, state, sockets):
+        """Carries on serving the sessions and handshakes of the server that handed over its sockets.
+
+        Deflate streams start over, the new one needs nothing from the old
+        one, so clients inflate on without noticing.
+        """
+        if self.history.log is None:
+            self.history.ring.extend(tuple(x) for x in state['history'])
+            self.history.next_seq = state['next_seq']
+        now = time.monotonic()
+        for item in state['sessions']:
+            connection = sockets[item['socket']]
+            connection.setblocking(False)
+            session = self.restore_session(item, connection)
+            session.outbox = Outbox(self.high_water)
+            if item['outbox']:
+                session.outbox.append(item['outbox'])
+            self.sessions.add(session)
+            for channel in item['channels']:
+                self.channels.join(session, channel)
+            if session.token is not None:
+                self.RESUMABLE[session.token] = session
+            if item['throttled'] is not None:
+                self.THROTTLED[connection] = item['throttled']
+            else:
+                self.watch(connection)
+            if session.decoder is not None and self.ping_interval is not None:
+                self.timers.schedule(session.last_seen + self.ping_interval, (self.check_idle, session))
+            if len(session.outbox) or session.stream is not None:
+                self.set_writable(connection, True)
+        for item in state['handshakes']:
+            connection = sockets[item['socket']]
+            connection.setblocking(False)
+            handshake = Handshake(connection, item['address'], item['deadline'])
+            if item['buffer'] is not None:
+                handshake.decoder = FrameDecoder()
+                handshake.decoder.buffer = bytearray(item['buffer'])
+            self.HANDSHAKES[connection] = handshake
+            self.watch(connection)
+        if self.resume_window is not None:
+            for item in state['detached']:
+                session = self.restore_session(item, None)
+                session.channels = frozenset(item['channels']) or NO_CHANNELS
+                self.RESUMABLE[session.token] = session
+                self.timers.schedule(now + self.resume_window, (self.expire_token, session))
+        server_log.info('Took over {0} sessions', len(self.sessions))
+
+    def restore_session(self, item, connection):
+        """Makes a session from its state in a snapshot."""
+        session = Session(connection, item['name'], item['address'])
+        if item['buffer'] is not None:
+            session.decoder = FrameDecoder()
+            session.decoder.buffer = bytearray(item['buffer'])
+        if item['compress']:
+            session.compressor = FrameCompressor(self.compress_threshold or COMPRESS_THRESHOLD)
+        session.presence = item['presence']
+        session.sequenced = item['sequenced']
+        session.token = item['token']
+        session.last_seen = item['last_seen']
+        session.held = item['held']
+        if item['stream'] is not None:
+            session.stream = [restore_stream(x) for x in item['stream']]
+        return session
+
+    def check_sockets(self, timeout=0):
+        """Checks sockets for new messages, waiting up to timeout seconds."""
+        to_read = [self.server_sock]
+        if self.shard is not None:
+            to_read.append(self.shard.sock)
+        if self.federation is not None:
+            to_read.extend(self.federation.links)
+        if self.THROTTLED:
+            to_read.extend(x for x in self.sessions.sockets() if x not in self.THROTTLED)
+        else:
+            to_read.extend(self.sessions.sockets())
+        to_read.extend(self.HANDSHAKES)
+        to_write = list(self.WRITERS)
+        if self.flush_at is not None:
+            timeout = max(0, min(timeout, self.flush_at - time.monotonic()))
+        if self.presence_at is not None:
+            timeout = max(0, min(timeout, self.presence_at - time.monotonic()))
+
+        read, write, err = select.select(to_read, to_write, [], timeout)
+        start = time.perf_counter() if self.metrics is not None else None
+        for connection in write:
+            self.handle_writable(connection)
         for connection in read:
             if connection is sys.stdin:
                 continue
-            try:
-                if connection is self.server_sock:
-                    self.accept_connection(connection)
+            self.handle_readable(connection)
+        self.tick()
+        if self.presence_at is not None and time.monotonic() >= self.presence_at:
+            self.flush_presence()
+        if self.flush_at is not None and time.monotonic() >= self.flush_at:
+            self.flush_pending()
+        if start is not None and (read or write):
+            self.metrics.loop_time.observe(time.perf_counter() - start)
+
+    def handle_readable(self, connection):
+        """Accepts or reads from a socket that is ready."""
+        try:
+            if connection is self.server_sock:
+                self.accept_connection(connection)
+            elif connection in self.sessions:
+                self.read_message(self.sessions.get(connection))
+            elif connection in self.HANDSHAKES:
+                self.read_handshake(self.HANDSHAKES[connection])
+            elif self.shard is not None and connection is self.shard.sock:
+                self.read_shard()
+            elif self.federation is not None and connection in self.federation.links:
+                self.federation.read(connection)
+        except ConnectionResetError:
+            server_log.info('Connection Reset')
+            self.disconnect(connection)
+        if self.federation is not None and self.federation.dirty:
+            self.federation.flush()
+
+    def handle_writable(self, connection):
+        """Writes the data queued for a socket until it would block."""
+        if connection in self.LINGERING:
+            self.flush_lingering(connection)
+            return
+        if self.federation is not None and connection in self.federation.connecting:
+            self.federation.connected(connection)
+            return
+        session = self.sessions.get(connection)
+        if session is None and self.federation is not None:
+            session = self.federation.links.get(connection)
+        if session is None:
+            return
+        outbox = session.outbox
+        streaming = isinstance(session, Session) and session.stream is not None
+        if streaming:
+            streaming = self.pump_stream(session)
+        queued = len(outbox)
+        try:
+            remaining = outbox.flush(connection)
+        except OSError:
+            # The peer is gone, the read side will notice and disconnect it
+            outbox.clear()
+            queued = remaining = 0
+            streaming = False
+        if self.metrics is not None:
+            self.metrics.bytes_out += queued - remaining
+        self.set_writable(connection, remaining > 0 or streaming)
+        if outbox.over_high_water():
+            self.SLOW.add(connection)
+
+    def set_writable(self, connection, writable):
+        """Tracks which sockets have data waiting for them to become writable."""
+        if writable:
+            self.WRITERS.add(connection)
+        else:
+            self.WRITERS.discard(connection)
+
+    def schedule_flush(self):
+        """Sets when the data queued in this loop iteration is written, select wakes up for it."""
+        self.flush_at = time.monotonic() + self.flush_delay
+
+    def flush_pending(self):
+        """Writes the data queued for each client since the last flush, one call per client."""
+        pending, self.PENDING = self.PENDING, set()
+        self.flush_at = None
+        for connection in pending:
+            if connection in self.sessions:
+                self.handle_writable(connection)
+
+    def schedule_presence(self):
+        """Sets when the joins and leaves gathered from now on are sent, select wakes up for it."""
+        self.presence_at = time.monotonic() + self.presence_window
+
+    def flush_presence(self):
+        """Sends the joins and leaves gathered since the last flush.
+
+        Clients that asked for presence deltas get them in a few presence
+        frames encoded once for everybody. The others get a connection or
+        disconnection message per user, and the ones that opted out nothing.
+        """
+        self.presence_at = None
+        changes = self.presence.take()
+        if not changes:
+            return
+        delta = []
+        events = []
+        for session in self.sessions:
+            if session.presence == DELTA:
+                delta.append(session)
+            elif session.presence == EVENTS:
+                events.append(session)
+        if delta:
+            for i in range(0, len(changes), ROSTER_FRAME):
+                self.send('presence', encode_delta(changes[i:i + ROSTER_FRAME]), delta)
+        if events:
+            for name, joined in changes:
+                if joined:
+                    # Users are not told about their own connection
+                    self.send('connection', name, [x for x in events if x.name != name])
                 else:
-                    self.read_message(connection)
-            except ConnectionResetError:
-                post_message('> ', 'Connection Reset\n')
-                self.disconnect_message(connection)
+                    self.send('disconnection', name, events)
+
+    def presence_changed(self, name, joined):
+        """Records that a user joined or left, to be announced with the others at the end of the window."""
+        if self.presence.change(name, joined):
+            self.schedule_presence()
+
+    def tick(self):
+        """Disconnects the clients that stayed over their outbox's high-water mark for too long.
+
+        Also drops the connections that did not finish their handshake in time
+        and resumes reading from the ones that waited out their rate limit.
+        Then pings the users that have been quiet and reaps the ones that did
+        not answer.
+        """
+        if self.HANDSHAKES:
+            self.expire_handshakes()
+        if self.THROTTLED:
+            self.resume_throttled()
+        now = time.monotonic()
+        if self.LINGERING:
+            self.expire_lingering(now)
+        for callback, item in self.timers.advance(now):
+            callback(item, now)
+        if self.federation is not None:
+            if self.federation.dialing or self.federation.connecting:
+                self.federation.dial()
+            self.federation.flush()
+        if not self.SLOW:
+            return
+        now = time.monotonic()
+        for connection in list(self.SLOW):
+            session = self.sessions.get(connection)
+            outbox = session.outbox if session else None
+            if outbox is None or not (outbox.overflowed or outbox.over_high_water()):
+                self.SLOW.discard(connection)
+            elif outbox.stalled(now, self.slow_timeout):
+                self.evict(session, 'slow_consumer')
+
+    def watch_idle(self, session):
+        """Starts the heartbeat of a new session.
+
+        Legacy clients can not answer pings, the kernel's keepalive finds
+        their dead connections instead.
+        """
+        session.last_seen = time.monotonic()
+        if session.decoder is None:
+            session.connection.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        elif self.ping_interval is not None:
+            self.timers.schedule(session.last_seen + self.ping_interval, (self.check_idle, session))
+
+    def check_idle(self, session, now):
+        """Pings a user quiet for the ping interval and disconnects one quiet for the idle timeout.
+
+        Each session has one timer at a time, set again here for whichever
+        comes next. Reads only update last_seen, they never touch the wheel.
+        A user that does not answer is pinged again every ping interval.
+        """
+        if self.sessions.get(session.connection) is not session:
+            return
+        idle = now - session.last_seen
+        if self.idle_timeout is not None and idle >= self.idle_timeout:
+            server_log.info('{0} has been idle for {1:.0f}s', session.name, idle)
+            # The client may only have lost its network, let it resume
+            self.evict(session, 'idle_timeout', resumable=True)
+        elif idle >= self.ping_interval:
+            self.release_idle(session, now)
+            self.send('ping', '', [session])
+            deadline = now + self.ping_interval
+            if self.idle_timeout is not None:
+                deadline = min(deadline, session.last_seen + self.idle_timeout)
+            self.timers.schedule(deadline, (self.check_idle, session))
+        else:
+            self.timers.schedule(session.last_seen + self.ping_interval, (self.check_idle, session))
+
+    def release_idle(self, session, now):
+        """Lets go of what a quiet session only needs while it is busy, it is made again the next time.
+
+        Rate buckets are only dropped once full, a new bucket starts full.
+        """
+        if session.compressor is not None:
+            session.compressor.release()
+        buckets = session.buckets
+        if buckets is not None:
+            for bucket in buckets.values():
+                bucket.refill(now)
+            if all(x.tokens >= x.burst for x in buckets.values()):
+                session.buckets = None
+
+    def memory_report(self):
+        """Measures the memory the connections take, to size a server for a number of users.
+
+        The resident memory added since the server started is shared out over
+        the connections, next to what the sessions' objects take, the data
+        queued for them and the deflate streams they have, which zlib
+        allocates outside Python.
+        """
+        report = {
+            'connections': len(self.sessions),
+            'handshakes': len(self.HANDSHAKES),
+            # Called from the metrics and command threads while the loop changes the dict
+            'detached': sum(1 for x in list(self.RESUMABLE.values()) if self.sessions.get(x.connection) is not x),
+            'resident': resident_memory(),
+            'per_connection': None,
+            'sessions': 0,
+            'queued': 0,
+            'deflaters': 0,
+        }
+        for session in list(self.sessions):
+            report['sessions'] += session.footprint()
+            if session.outbox is not None:
+                report['queued'] += len(session.outbox)
+            if session.compressor is not None and session.compressor.deflater is not None:
+                report['deflaters'] += 1
+        if report['connections'] and report['resident'] is not None and self.baseline_memory is not None:
+            report['per_connection'] = (report['resident'] - self.baseline_memory) / report['connections']
+        return report
+
+    def take_resumable(self, option, username):
+        """Returns the session a resume option names and the last sequence number its client saw.
+
+        The option is the token handed to the client and the sequence number,
+        separated by a colon. If the old connection still looks alive it is
+        half-open, the client already gave up on it, so it is disconnected.
+        Returns None if the token is unknown, expired or belongs to another name.
+        """
+        token, sep, seq = option.partition(':')
+        session = self.RESUMABLE.get(token)
+        if session is None or session.name != username:
+            return None
+        try:
+            seq = int(seq)
+        except ValueError:
+            return None
+        if self.sessions.get(session.connection) is session:
+            self.disconnect(session.connection)
+        del self.RESUMABLE[token]
+        return session, seq
+
+    def start_session(self, session, previous=None):
+        """Hands a resume token to a session that asked for one and replays what it missed if it is resuming.
+
+        The session frame carries the token and the sequence number the
+        client has seen up to. A resumed session rejoins its channels and gets
+        the messages it may see since then as they were first sent, followed
+        by a resumed frame with their count and the number that were too old
+        to still be kept.
+        """
+        session.sequenced = True
+        if self.resume_window is None:
+            self.send('session', '- {0}'.format(self.history.next_seq - 1), [session])
+            return
+        session.token = secrets.token_hex(16)
+        self.RESUMABLE[session.token] = session
+        if previous is None:
+            self.send('session', '{0} {1}'.format(session.token, self.history.next_seq - 1), [session])
+            return
+        previous, seq = previous
+        self.send('session', '{0} {1}'.format(session.token, seq), [session])
+        for channel in previous.channels:
+            members = self.channels.subscribers(channel)
+            if self.channels.join(session, channel):
+                self.send('channel_join', '{0} {1}'.format(channel, session.name),
+                          [x for x in members if x is not session])
+                self.relay('channel_join', '{0} {1}'.format(channel, session.name))
+        missed = max(0, self.history.first_seq() - seq - 1)
+        self.start_stream(session, HistoryReplay(seq + 1, self.history.next_seq, resume=True, missed=missed))
+
+    @staticmethod
+    def sent_by(session, record):
+        """Checks if a recorded message was sent by a user, who was not sent it."""
+        seq, tag, body = record
+        if tag == 'whisper' or tag == 'channel':
+            body = split_message(body)[1]
+        return split_message(body)[0] == session.name
+
+    def detach(self, session, channels):
+        """Keeps a disconnected session that can be resumed until the resume window is over."""
+        session.channels = frozenset(channels) or NO_CHANNELS
+        session.stream = None
+        session.held = None
+        self.timers.schedule(time.monotonic() + self.resume_window, (self.expire_token, session))
+
+    def expire_token(self, session, now):
+        """Forgets a detached session once its resume window is over."""
+        if self.RESUMABLE.get(session.token) is session and self.sessions.get(session.connection) is not session:
+            del self.RESUMABLE[session.token]
+
+    def evict(self, session, reason, resumable=False):
+        """Drops the data queued for a client, tells it why and disconnects it.
+
+        The error takes the place of the dropped data. If the socket can not
+        take it at once, as with a slow consumer whose socket buffer is full,
+        the connection lingers unread until the error is written or the slow
+        timeout passes, and only then is closed.
+        """
+        server_log.warning('Disconnecting {0}: {1}', session.name, reason)
+        if not resumable and session.token is not None:
+            del self.RESUMABLE[session.token]
+            session.token = None
+        connection = session.connection
+        outbox = session.outbox
+        session.outbox = None
+        self.PENDING.discard(connection)
+        outbox.drop_queued()
+        outbox.append(self.encode(session, 'error', reason))
+        try:
+            remaining = outbox.flush(connection)
+        except OSError:
+            remaining = 0
+        if remaining:
+            self.LINGERING[connection] = (outbox, time.monotonic() + self.slow_timeout)
+        self.disconnect(connection)
+        if remaining:
+            self.set_writable(connection, True)
+
+    def flush_lingering(self, connection):
+        """Writes what is left for an evicted client, closing the connection once it is all written."""
+        outbox, deadline = self.LINGERING[connection]
+        try:
+            remaining = outbox.flush(connection)
+        except OSError:
+            remaining = 0
+        if not remaining:
+            self.close_lingering(connection)
+
+    def expire_lingering(self, now):
+        """Closes the connections of evicted clients that did not read their error in time."""
+        for connection, (outbox, deadline) in list(self.LINGERING.items()):
+            if deadline <= now:
+                self.close_lingering(connection)
+
+    def close_lingering(self, connection):
+        del self.LINGERING[connection]
+        self.set_writable(connection, False)
+        connection.close()
+
+    def watch(self, connection):
+        """Starts watching a new client socket, select picks it up from the sessions."""
+        pass
+
+    def unwatch(self, connection):
+        """Stops watching a client socket."""
+        pass
 
     def accept_connection(self, connection):
-        """Accepts a new connections and checks if the username is valid."""
-        client, address = connection.accept()
-        read1, write1, err1 = select.select([client], [], [], .1)
-        if client in read1:
-            username = client.recv(2 ** 16).decode().strip()
-            if username not in self.ACTIVE_SOCKETS.values():
-                self.ACTIVE_SOCKETS[client] = username
-                post_message('> ', 'Connection at {0} as {1}\n'.format(address, username))
-                message = 'connection {0}'.format(username)
-                self.server_broadcast(message, skip=[client])
-            else:
-                message_format = 'Connection at {0} as {1}.\n'
-                message_format += 'Username already taken, disconnecting\n'
-                post_message('> ', message_format.format(address, username))
-                data = generate_message_data('name_taken ' + username, 'error')
-                send_data(data, [client])
+        """Accepts the waiting connections, up to a batch, and starts their handshake.
+
+        Nothing is read here, each client is watched until it sends its hello
+        so a slow one never holds up the others. Sockets select could not
+        watch are closed at once.
+        """
+        deadline = time.monotonic() + self.handshake_timeout
+        for i in range(ACCEPT_BATCH):
+            try:
+                client, address = connection.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # Out of file descriptors or a connection reset while queued, the others can still be served
+                server_log.warning('Could not accept a connection: {0}', e)
+                break
+            if self.max_fd is not None and client.fileno() >= self.max_fd:
+                server_log.warning('Refused a connection from {0}, select can not watch more sockets', address)
                 client.close()
+                continue
+            client.setblocking(False)
+            self.HANDSHAKES[client] = Handshake(client, address, deadline)
+            self.watch(client)
+
+    def read_handshake(self, handshake):
+        """Reads what a connecting client sent, finishing the handshake once its hello is complete.
+
+        Clients speaking the framed protocol open with a hello frame, anything
+        else is treated as a legacy client sending its bare username.
+        """
+        client = handshake.connection
+        try:
+            data = client.recv(2 ** 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.reject(handshake)
+            return
+        if handshake.decoder is None and not is_frame(data):
+            try:
+                username = data.decode().strip()
+            except UnicodeDecodeError:
+                username = None
+            self.finish_handshake(handshake, '', username, [], [])
+            return
+        if handshake.decoder is None:
+            handshake.decoder = FrameDecoder()
+        try:
+            frames = handshake.decoder.feed(data)
+        except (ProtocolError, UnicodeDecodeError):
+            self.reject(handshake)
+            return
+        if not frames:
+            return
+        tag, hello = frames.pop(0)
+        version, rest = split_message(hello) if tag == 'hello' else ('', '')
+        username, options = split_message(rest)
+        self.finish_handshake(handshake, tag, username, options.split(), frames, hello)
+
+    def expire_handshakes(self):
+        """Drops the connections whose handshake timed out, they are kept in the order they were accepted."""
+        now = time.monotonic()
+        for handshake in list(self.HANDSHAKES.values()):
+            if handshake.deadline > now:
+                break
+            server_log.info('Attempted Connection at {0}. Handshake timed out, disconnecting.', handshake.address)
+            self.drop_handshake(handshake.connection)
+            if self.metrics is not None:
+                self.metrics.rejects += 1
+
+    def drop_handshake(self, connection):
+        """Forgets a connection still in its handshake and closes it."""
+        del self.HANDSHAKES[connection]
+        self.unwatch(connection)
+        connection.close()
+
+    def reject(self, handshake):
+        """Closes a connection that went away or sent a bad hello."""
+        self.drop_handshake(handshake.connection)
+        if self.metrics is not None:
+            self.metrics.rejects += 1
+        server_log.info('Attempted Connection at {0}. No username, disconnecting.', handshake.address)
+
+    def finish_handshake(self, handshake, tag, username, options, frames, hello=''):
+        """Checks if the username is valid and turns the connection into a session.
+
+        A hello may list options after the username, the server answers with
+        the ones it accepted, so far only deflate compression. The frames that
+        came after the hello are processed as soon as the user is in.
+        """
+        client = handshake.connection
+        address = handshake.address
+        decoder = handshake.decoder
+        if tag == 'peer' and self.federation is not None:
+            # The federation watches its links itself
+            del self.HANDSHAKES[client]
+            self.unwatch(client)
+            self.federation.accept(client, address, hello, decoder, frames)
+            return
+        if not username:
+            self.reject(handshake)
+            return
+        del self.HANDSHAKES[client]
+        session = Session(client, username, address, decoder)
+        sequenced = resuming = False
+        previous = None
+        if decoder is not None:
+            for option in options:
+                if option == RESUME or option.startswith(RESUME + '='):
+                    sequenced = True
+                    resuming = option != RESUME
+                    if resuming and self.resume_window is not None:
+                        previous = self.take_resumable(option[len(RESUME) + 1:], username)
+            accepted = [str(PROTOCOL_VERSION)]
+            if COMPRESSION in options and self.compress_threshold is not None:
+                accepted.append(COMPRESSION)
+            if NO_PRESENCE in options:
+                session.presence = None
+                accepted.append(NO_PRESENCE)
+            elif PRESENCE in options:
+                session.presence = DELTA
+                accepted.append(PRESENCE)
+            if sequenced:
+                accepted.append(RESUME)
+            self.send('hello', ' '.join(accepted), [session])
+            if COMPRESSION in accepted:
+                session.compressor = FrameCompressor(self.compress_threshold)
+        if self.sessions.find(username) is None and self.claim(username):
+            session.outbox = Outbox(self.high_water)
+            self.sessions.add(session)
+            if self.metrics is not None:
+                self.metrics.accepts += 1
+            # Writes are already batched per loop iteration, Nagle would only delay them
+            client.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            self.watch_idle(session)
+            if sequenced:
+                self.start_session(session, previous)
+                if resuming and previous is None:
+                    self.send('error', 'resume_failed', [session])
+            server_log.info('Connection at {0} as {1}{2}', address, username, ', resumed' if previous else '')
+            self.presence_changed(username, True)
+            self.relay('join', username)
+            self.process_frames(session, frames)
+            if self.shard is not None and self.shard.backlog:
+                self.process_shard(self.shard.take_backlog())
         else:
+            server_log.info('Connection at {0} as {1}. Username already taken, disconnecting', address, username)
+            if self.metrics is not None:
+                self.metrics.rejects += 1
+            self.send('error', 'name_taken ' + username, [session])
+            self.unwatch(client)
             client.close()
-            post_message('> ', 'Attempted Connection at {0}\n'.format(address))
-            post_message('> ', 'No username, disconnecting.\n')
 
-    def read_message(self, connection):
-        """Reads and processes a message send by a user."""
-        data = connection.recv(2 ** 16)
+    def read_message(self, session):
+        """Reads the data sent by a user and processes each message in it."""
+        try:
+            data = session.connection.recv(2 ** 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # Resets, and the keepalive probes of legacy connections going unanswered
+            server_log.info('Lost the connection of {0}: {1}', session.name, e)
+            data = b''
         if data:
-            name = self.ACTIVE_SOCKETS[connection]
-            message = data.decode().strip()
-            tag, message = split_message(message)
-            post_message('> ', '[{0}] <{1}> {2}\n'.format(name, tag, message))
-                
-            if tag == 'message':
-                self.user_message(message, connection)
-            elif tag == 'username':
-                max_users, message = split_message(message)
-                self.username_request(max_users, connection)
-            elif tag == 'whisper':
-                username, message = split_message(message)
-                if message is None or username is None:
-                    return None
-                recipient = [k for k, v in self.ACTIVE_SOCKETS.items() if v == username]
-                if len(recipient) == 1:
-                    data = generate_message_data(message, 'whisper', name)
-                    send_data(data, recipient)
-                else:
-                    message_format = 'no_name_whisper {0}\n'
-                    message = message_format.format(username)
-                    data = generate_message_data(message, 'error')
-                    post_message('> ', message)
-                    send_data(data, connection)
+            session.last_seen = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.bytes_in += len(data)
+            if session.decoder is None:
+                try:
+                    frames = [split_message(data.decode())]
+                except UnicodeDecodeError:
+                    server_log.warning('Malformed message from {0}', session.name)
+                    self.disconnect(session.connection)
+                    return
+            else:
+                try:
+                    frames = session.decoder.feed(data)
+                except (ProtocolError, UnicodeDecodeError):
+                    server_log.warning('Malformed frame from {0}', session.name)
+                    self.disconnect(session.connection)
+                    return
+            self.process_frames(session, frames)
         else:
-            self.disconnect(connection)
+            self.disconnect(session.connection)
+
+    def process_frames(self, session, frames):
+        """Processes each message read from a user while they remain connected and within their rate limit."""
+        limits = self.limits
+        now = time.monotonic() if limits is not None else None
+        for i, (tag, message) in enumerate(frames):
+            if session.connection not in self.sessions:
+                break
+            # Pongs answer the server, charging them would also bring back the buckets of quiet sessions
+            if limits is not None and tag != 'pong':
+                wait = limits.check(session, tag, now, self.fanout(tag, message))
+                if wait:
+                    if self.over_limit(session, tag, frames[i:], now + wait):
+                        break
+                    continue
+                session.limited = False
+            self.process_message(session, tag, message)
+
+    def fanout(self, tag, message):
+        """Returns the number of users a message from a user goes to, if it counts against the fanout budget."""
+        if self.limits.fanout is None or tag not in FANOUT_TAGS:
+            return 0
+        if tag == 'message':
+            return len(self.sessions) - 1
+        channel, message = split_message(message)
+        channel = channel_name(channel)
+        return len(self.channels.subscribers(channel)) if channel is not None else 0
+
+    def over_limit(self, session, tag, frames, resume):
+        """Applies the rate limit policy to a message sent too fast, returns True if the rest must not be processed.
+
+        Under the delay policy the message and the ones after it are held
+        until resume and nothing more is read from the connection meanwhile.
+        The drop policy only tells the user once until a message gets through.
+        """
+        if self.metrics is not None:
+            self.metrics.rate_limited(tag)
+        policy = self.limits.policy
+        if policy == DELAY:
+            session.held = frames
+            self.THROTTLED[session.connection] = resume
+            self.unwatch(session.connection)
+            return True
+        if policy == DISCONNECT:
+            self.evict(session, 'flooding')
+            return True
+        if not session.limited:
+            session.limited = True
+            server_log.info('Dropping messages from {0}: rate limited', session.name)
+            self.send('error', 'rate_limited ' + tag, [session])
+        return False
+
+    def resume_throttled(self):
+        """Processes the messages held for the connections whose wait is over and reads from them again."""
+        now = time.monotonic()
+        for connection, resume in list(self.THROTTLED.items()):
+            if resume > now:
+                continue
+            del self.THROTTLED[connection]
+            session = self.sessions.get(connection)
+            if session is None:
+                continue
+            frames, session.held = session.held, None
+            self.process_frames(session, frames)
+            if connection in self.sessions and connection not in self.THROTTLED:
+                self.watch(connection)
+
+    def process_message(self, session, tag, message):
+        """Processes a message send by a user."""
+        name = session.name
+        server_log.debug('[{0}] <{1}> {2}', name, tag, message)
+        if self.metrics is not None:
+            self.metrics.message_in(tag)
+
+        if tag == 'message':
+            self.user_message(message, session)
+        elif tag == 'username':
+            max_users, message = split_message(message)
+            self.username_request(max_users, session)
+        elif tag == 'whisper':
+            username, message = split_message(message)
+            if message is None or username is None:
+                return None
+            recipient = self.sessions.find(username)
+            if isinstance(recipient, RemoteUser):
+                self.history.append('whisper', '{0} {1} {2}'.format(username, name, message))
+                recipient.link.send('whisper', '{0} {1} {2}'.format(username, name, message))
+            elif recipient is not None:
+                self.deliver_whisper(recipient, '{0} {1}'.format(name, message))
+            else:
+                message = 'no_name_whisper {0}'.format(username)
+                server_log.debug(message)
+                self.send('error', message, [session])
+        elif tag == 'channel':
+            channel, message = split_message(message)
+            self.channel_message(message, channel, session)
+        elif tag == 'join':
+            self.join_channel(message, session)
+        elif tag == 'leave':
+            self.leave_channel(message, session)
+        elif tag == 'channels':
+            self.channel_list(session)
+        elif tag == 'history':
+            self.history_request(message, session)
+        elif tag == 'users':
+            self.users_request(message, session)
+        elif tag == 'ping':
+            self.send('pong', message, [session])
 
     def disconnect(self, connection, suppress=False):
         """Disconnects a user from the server."""
-        connection.close()
-        if not suppress:
-            self.disconnect_message(connection)
-        if connection in self.ACTIVE_SOCKETS:
-            self.ACTIVE_SOCKETS[connection] = None
+        if connection in self.PENDING:
+            # Last chance for what was queued, like a shutdown message
+            self.PENDING.discard(connection)
+            self.handle_writable(connection)
+        self.set_writable(connection, False)
+        self.unwatch(connection)
+        if connection not in self.LINGERING:
+            connection.close()
+        self.SLOW.discard(connection)
+        self.THROTTLED.pop(connection, None)
+        session = self.sessions.get(connection)
+        if session is not None:
+            self.sessions.remove(session)
+            channels = self.leave_channels(session, not suppress)
+            if session.token is not None:
+                self.detach(session, channels)
+            if not suppress:
+                self.relay('leave', session.name)
+                self.disconnect_message(session.name)
 
-    def disconnect_message(self, connection):
+    def disconnect_message(self, name):
         """Sends a message that a user disconnected to the remaining users."""
-        if connection in self.ACTIVE_SOCKETS:
-            name = self.ACTIVE_SOCKETS.pop(connection)
-            message = 'disconnection {0}\n'.format(name)
-            post_message('> ', message)
-            self.server_broadcast(message)
-
-    def server_broadcast(self, message, skip=list()):
-        """Broadcasts a message from the server to all users."""
-        data = generate_message_data(message, 'server_broadcast')
-        skip.append(self.server_sock)
-        recipients = [x for x in self.ACTIVE_SOCKETS if x not in skip]
-        send_data(data, recipients)
-
-    def user_message(self, message, sender_sock):
+        server_log.info('disconnection {0}', name)
+        self.presence_changed(name, False)
+
+    def user_message(self, message, sender):
         """Sends a message from a user to the other users."""
-        name = self.ACTIVE_SOCKETS[sender_sock]
-        skip = [self.server_sock, sender_sock]
-        data = generate_message_data(message, 'user_message', name)
-        recipients = [x for x in self.ACTIVE_SOCKETS if x not in skip]
-        send_data(data, recipients)
+        recipients = [x for x in self.sessions if x is not sender]
+        message = '{0} {1}'.format(sender.name, message)
+        seq = self.history.append('message', message)
+        self.send('message', message, recipients, seq)
+        self.relay('message', message)
 
-    def username_request(self, max_users, sender_sock):
-        """Sends a list of usernames to the requesting user."""
+    def deliver_whisper(self, recipient, message):
+        """Sends a whisper to a local user and records it."""
+        seq = self.history.append('whisper', '{0} {1}'.format(recipient.name, message))
+        self.send('whisper', message, [recipient], seq)
+
+    def history_request(self, message, session):
+        """Starts replaying the last N messages or the messages since a sequence number to a user."""
+        kind, number = split_message(message)
+        try:
+            number = int(number)
+        except ValueError:
+            kind = None
+        if kind == 'last':
+            seq = self.history.next_seq - number
+        elif kind == 'since':
+            seq = number
+        else:
+            self.send('error', 'bad_history {0}'.format(message), [session])
+            return
+        self.start_stream(session, HistoryReplay(seq, self.history.next_seq))
+
+    def users_request(self, message, session):
+        """Starts streaming a page of the roster to a user.
+
+        The request is the page size (-1 for every user), the cursor ending
+        the previous page or - to start, and an optional name prefix.
+        """
+        count, rest = split_message(message)
+        cursor, prefix = split_message(rest)
+        try:
+            count = int(count)
+            after = decode_cursor(cursor or '-')
+            # An error inside the stream would stop the loop, so the prefix is tried out first
+            self.sessions.count_prefix(prefix)
+        except ValueError:
+            self.send('error', 'bad_users {0}'.format(message), [session])
+            return
+        self.start_stream(session, RosterPage(after, prefix, count if count >= 0 else None))
+
+    def start_stream(self, session, stream):
+        """Starts sending a long response, which is queued as the user reads it, after any already started."""
+        if session.stream is None:
+            session.stream = [stream]
+        else:
+            session.stream.append(stream)
+        self.handle_writable(session.connection)
+
+    def pump_stream(self, session):
+        """Queues more of a user's streamed responses while their outbox is under half its high-water mark.
+
+        Returns False once the responses are finished.
+        """
+        outbox = session.outbox
+        streams = session.stream
+        while len(outbox) < outbox.high_water // 2:
+            frame = streams[0].next_frame(self, session)
+            if frame is None:
+                del streams[0]
+                if not streams:
+                    session.stream = None
+                    return False
+                continue
+            outbox.append(self.encode(session, *frame))
+        return True
+
+    @staticmethod
+    def can_see(session, record):
+        """Checks if a user may see a recorded message."""
+        seq, tag, body = record
+        if tag == 'whisper':
+            target, rest = split_message(body)
+            return session.name == target or session.name == split_message(rest)[0]
+        elif tag == 'channel':
+            return split_message(body)[0] in session.channels
+        return True
+
+    def join_channel(self, channel, session):
+        """Subscribes a user to a channel and tells its other members."""
+        name = channel_name(channel)
+        if name is None:
+            self.send('error', 'no_channel {0}'.format(channel), [session])
+            return
+        members = self.channels.subscribers(name)
+        if self.channels.join(session, name):
+            self.send('channel_join', '{0} {1}'.format(name, session.name), [x for x in members if x is not session])
+            self.relay('channel_join', '{0} {1}'.format(name, session.name))
+        self.send('joined', '{0} {1}'.format(name, self.channels.count(name)), [session])
+
+    def leave_channel(self, channel, session):
+        """Unsubscribes a user from a channel and tells its remaining members."""
+        name = channel_name(channel)
+        if name is None or not self.channels.leave(session, name):
+            self.send('error', 'no_channel {0}'.format(channel), [session])
+            return
+        self.send('channel_leave', '{0} {1}'.format(name, session.name), self.channels.subscribers(name))
+        self.relay('channel_leave', '{0} {1}'.format(name, session.name))
+        self.send('left', name, [session])
+
+    def leave_channels(self, user, notify=True):
+        """Removes a local or remote user from all their channels, telling the local members, and returns them."""
+        channels = self.channels.leave_all(user)
+        if notify:
+            for channel in channels:
+                self.send('channel_leave', '{0} {1}'.format(channel, user.name), self.channels.subscribers(channel))
+        return channels
+
+    def remote_channel(self, user, channel, joined):
+        """Applies a user of another shard or server joining or leaving a channel and tells the local members."""
+        if joined:
+            changed = self.channels.join(user, channel)
+        else:
+            changed = self.channels.leave(user, channel)
+        if changed:
+            tag = 'channel_join' if joined else 'channel_leave'
+            self.send(tag, '{0} {1}'.format(channel, user.name), self.channels.subscribers(channel))
+
+    def channel_list(self, session):
+        """Sends the channels and their member counts, across every shard and server, to the requesting user."""
+        listing = ' '.join('{0}:{1}'.format(name, count) for name, count in self.channels.listing())
+        self.send('channels', listing, [session])
+
+    def channel_message(self, message, channel, sender):
+        """Sends a message from a user to the other members of a channel."""
+        name = channel_name(channel)
+        if name is None or name not in sender.channels:
+            self.send('error', 'no_channel {0}'.format(channel), [sender])
+            return
+        message = '{0} {1} {2}'.format(name, sender.name, message)
+        seq = self.history.append('channel', message)
+        self.send('channel', message, [x for x in self.channels.subscribers(name) if x is not sender], seq)
+        self.relay('channel', message)
 
-        user_list = list(self.ACTIVE_SOCKETS.values())
-        user_list.remove('Server')
-        user_list_len = len(user_list)
+    def deliver_channel(self, message):
+        """Sends a channel message relayed from another shard or server to the local members."""
+        channel, rest = split_message(message)
+        seq = self.history.append('channel', message)
+        self.send('channel', message, self.channels.subscribers(channel), seq)
+
+    def relay(self, tag, message):
+        """Passes an event about a local user on to the other shards and federated servers."""
+        if self.shard is not None and tag != 'join':
+            # Joins reach the other shards through the claim
+            self.shard.send(tag, message)
+        if self.federation is not None:
+            if tag in ('join', 'leave', 'channel_join', 'channel_leave'):
+                message = '{0} {1}'.format(message, self.federation.server_id)
+            self.federation.publish(tag, message)
+
+    def remote_join(self, user):
+        """Adds a user connected to another shard or server."""
+        self.sessions.add(user)
+        self.presence_changed(user.name, True)
+
+    def remote_leave(self, user):
+        """Removes a user connected to another shard or server."""
+        self.sessions.remove(user)
+        self.leave_channels(user)
+        self.presence_changed(user.name, False)
+
+    def deliver(self, tag, message):
+        """Sends a message relayed from another shard or server to every local user."""
+        seq = self.history.append(tag, message)
+        self.send(tag, message, list(self.sessions), seq)
+
+    def claim(self, username):
+        """Checks that no other shard has a user with the name, reserving it for this one."""
+        if self.shard is None:
+            return True
+        try:
+            return self.shard.claim(username)
+        except (ConnectionError, ProtocolError) as e:
+            self.lose_shard(e)
+            return False
+
+    def read_shard(self):
+        """Reads the events relayed by the shard hub, stopping the server if the hub is gone."""
+        try:
+            frames = self.shard.receive()
+        except (ConnectionError, ProtocolError) as e:
+            self.lose_shard(e)
+            return
+        self.process_shard(frames)
+
+    def lose_shard(self, error):
+        """Stops the server once the shard hub is gone or no longer answers."""
+        self.unwatch(self.shard.sock)
+        if self.running:
+            server_log.error('Lost the connection to the shard hub: {0}', error)
+            self.stop()
+
+    def process_shard(self, frames):
+        """Applies the events relayed from the other shards to this one's users."""
+        for tag, message in frames:
+            if tag == 'join':
+                self.remote_join(RemoteUser(message, self.shard))
+            elif tag == 'leave':
+                user = self.sessions.find(message)
+                if isinstance(user, RemoteUser):
+                    self.remote_leave(user)
+            elif tag == 'message':
+                self.deliver('message', message)
+            elif tag == 'channel':
+                self.deliver_channel(message)
+            elif tag in ('channel_join', 'channel_leave'):
+                channel, name = split_message(message)
+                user = self.sessions.find(name)
+                if isinstance(user, RemoteUser):
+                    self.remote_channel(user, channel, tag == 'channel_join')
+            elif tag == 'whisper':
+                username, message = split_message(message)
+                recipient = self.sessions.find(username)
+                if isinstance(recipient, Session):
+                    self.deliver_whisper(recipient, message)
+            elif tag == 'shutdown':
+                self.stop()
+
+    def username_request(self, max_users, sender):
+        """Sends a list of usernames to the requesting user."""
+        user_list_len = self.sessions.roster_size()
         try:
             max_users = int(max_users)
         except:
@@ -137,47 +1195,165 @@ class ChatServer:
 
         if max_users == 0:
             user_list = []
-            len_diff = user_list_len
         elif max_users < 0:
-            len_diff = 0
+            user_list = self.sessions.page(0, user_list_len)
         else:
-            user_list = user_list[:max_users]
-            len_diff = user_list_len - len(user_list)
+            user_list = self.sessions.page(0, max_users)
+        len_diff = user_list_len - len(user_list)
         message = ' '.join(user_list)
-        data = generate_message_data(message, 'username', None, len_diff)
-        send_data(data, [sender_sock])
+        self.send('username', '{0} {1}'.format(len_diff, message), [sender])
+
+    def send(self, tag, message, recipients, seq=None):
+        """Sends a message to the given sessions, encoding it once per protocol.
 
+        Sessions that can resume get the sequence number of a recorded
+        message in front of its body.
+        """
+        if self.metrics is not None:
+            self.metrics.message_out(tag, len(recipients))
+        framed = legacy = sequenced = None
+        for session in recipients:
+            if session.sequenced and seq is not None:
+                if sequenced is None:
+                    sequenced = encode_frame(tag, '{0} {1}'.format(seq, message))
+                if session.compressor is not None and session.compressor.wants(sequenced):
+                    self.queue(session, session.compressor.compress(sequenced))
+                else:
+                    self.queue(session, sequenced)
+            elif session.decoder is not None:
+                if framed is None:
+                    framed = encode_frame(tag, message)
+                if session.compressor is not None and session.compressor.wants(framed):
+                    self.queue(session, session.compressor.compress(framed))
+                else:
+                    self.queue(session, framed)
+            else:
+                if legacy is None:
+                    legacy = encode_legacy(tag, message)
+                self.queue(session, legacy)
 
-def split_message(message):
-    """Splits a message into its tag and the body of the message"""
-    split = message.strip().split(sep=None, maxsplit=1)
-    if len(split) == 0:
-        return '', ''
-    elif len(split) == 1:
-        return split[0], ''
-    else:
-        return split[0], split[1]
+    @staticmethod
+    def encode(session, tag, message):
+        """Encodes a message in the protocol a session speaks, compressing it if the session asked for that."""
+        if session.decoder is None:
+            return encode_legacy(tag, message)
+        frame = encode_frame(tag, message)
+        if session.compressor is not None and session.compressor.wants(frame):
+            return session.compressor.compress(frame)
+        return frame
 
+    def queue(self, session, data):
+        """Queues data for a session, it is written with everything else queued in this loop iteration.
 
-def send_data(data, recipients):
-    """Sends data to a the given recipients."""
-    if data is not None:
-        try:
-            for connection in recipients:
-                connection.send(data)
-        except TypeError:
-            recipients.send(data)
-
-
-def generate_message_data(message, message_type, sender=None, *args):
-    """Generates and encodes the message data with """
-    if message_type == 'user_message':
-        return 'message {0} {1}'.format(sender, message).encode()
-    elif message_type == 'server_broadcast':
-        return '{0}'.format(message).encode()
-    elif message_type == 'username':
-        return 'username {0} {1}'.format(args[0], message).encode()
-    elif message_type == 'error':
-        return 'error {0}'.format(message).encode()
-    elif message_type == 'whisper':
-        return 'whisper {0} {1}'.format(sender, message).encode()
+        Every recipient of a broadcast queues the same encoded bytes, nothing
+        is copied until the kernel takes it.
+        """
+        outbox = session.outbox
+        connection = session.connection
+        if outbox is None:
+            # Still in the handshake, nothing else was sent so the short reply fits in the socket buffer
+            connection.send(data)
+        elif not outbox.append(data):
+            self.SLOW.add(connection)
+        elif connection not in self.WRITERS:
+            if outbox.over_high_water():
+                # Enough for a large write already, do not let it grow until the flush
+                self.PENDING.discard(connection)
+                self.handle_writable(connection)
+            elif connection not in self.PENDING:
+                if not self.PENDING:
+                    self.schedule_flush()
+                self.PENDING.add(connection)
+        elif outbox.over_high_water():
+            self.SLOW.add(connection)
+
+
+class AsyncChatServer(ChatServer):
+    """Chat server driven by an asyncio event loop.
+
+    The loop blocks until a socket is ready instead of polling, and uses the
+    platform selector (epoll/kqueue) so it is not bound by the select fd limit.
+    """
+    max_fd = None
+
+    def __init__(self, port, **options):
+        self.loop = asyncio.new_event_loop()
+        ChatServer.__init__(self, port, **options)
+
+    def run(self):
+        """Runs the event loop until the server is stopped."""
+        asyncio.set_event_loop(self.loop)
+        self.running = True
+        self.loop.add_reader(self.server_sock, self.handle_readable, self.server_sock)
+        if self.shard is not None:
+            self.loop.add_reader(self.shard.sock, self.handle_readable, self.shard.sock)
+        self.tick_handle = self.loop.call_later(TICK_INTERVAL, self.schedule_tick)
+        self.loop.run_forever()
+        self.tick_handle.cancel()
+        self.loop.remove_reader(self.server_sock)
+
+    def stop(self):
+        """Stops the event loop, safe to call from another thread."""
+        self.running = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def close(self):
+        """Disconnects from all connections and closes the server and loop."""
+        ChatServer.close(self)
+        self.loop.close()
+
+    def release(self):
+        """Closes this process's copies of the sockets and the loop once a new process took them over."""
+        ChatServer.release(self)
+        self.loop.close()
+
+    def handle_readable(self, connection):
+        """Accepts or reads from a socket that is ready, timing it when metrics are kept."""
+        if self.metrics is None:
+            return ChatServer.handle_readable(self, connection)
+        start = time.perf_counter()
+        ChatServer.handle_readable(self, connection)
+        self.metrics.loop_time.observe(time.perf_counter() - start)
+
+    def watch(self, connection):
+        """Registers a client socket with the event loop."""
+        self.loop.add_reader(connection, self.handle_readable, connection)
+
+    def unwatch(self, connection):
+        """Removes a client socket from the event loop."""
+        if not self.loop.is_closed():
+            self.loop.remove_reader(connection)
+
+    def set_writable(self, connection, writable):
+        """Registers or removes the writer callback of a socket with the event loop."""
+        if writable and connection not in self.WRITERS:
+            self.loop.add_writer(connection, self.handle_writable, connection)
+        elif not writable and connection in self.WRITERS and not self.loop.is_closed():
+            self.loop.remove_writer(connection)
+        ChatServer.set_writable(self, connection, writable)
+
+    def schedule_flush(self):
+        """Writes the data queued in this loop iteration once the ready callbacks have run, or after the flush delay."""
+        if self.flush_delay:
+            self.loop.call_later(self.flush_delay, self.flush_pending)
+        else:
+            self.loop.call_soon(self.flush_pending)
+
+    def schedule_presence(self):
+        """Sends the joins and leaves gathered from now on after the presence window."""
+        self.loop.call_later(self.presence_window, self.flush_presence)
+
+    def schedule_tick(self):
+        """Runs the housekeeping and schedules the next tick."""
+        self.tick()
+        self.tick_handle = self.loop.call_later(TICK_INTERVAL, self.schedule_tick)
+
+
+def raise_fd_limit():
+    """Raises the soft limit on open files to the hard limit, the usual 1024 caps the number of connections.
+
+    Only for the asyncio engine, select can not watch descriptors past 1024.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard != resource.RLIM_INFINITY:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
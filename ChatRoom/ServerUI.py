@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
+import sys
 import threading
 import time
 import cmd
 from .ServerModule import *
+from .ShardModule import *
+from .FederationModule import *
 
 
 class ChatServerCMD(cmd.Cmd):
@@ -11,19 +14,76 @@ class ChatServerCMD(cmd.Cmd):
     file = None
     done = True
 
-    def __init__(self, port):
+    def __init__(self, port, use_async=False, workers=0, **options):
         cmd.Cmd.__init__(self)
-        self.chat_server = ChatServer(port)
+        if workers:
+            self.chat_server = ShardedServer(port, workers, use_async, **options)
+        elif use_async:
+            self.chat_server = AsyncChatServer(port, **options)
+        else:
+            self.chat_server = ChatServer(port, **options)
         self.receive_thread = CheckSocketsThread(self, self.chat_server)
+        self.successor = None
 
     def do_close(self, line):
         "Closes the server"
         self.done = True
         post_message('> ', 'Closing Server\n', True)
-        time.sleep(.1)
+        self.chat_server.stop()
+        self.receive_thread.join()
         self.chat_server.close()
+        server_log.close()
+        return True
+
+    def do_upgrade(self, line):
+        "Hands every connection to a new server process running the code on disk, without disconnecting anyone"
+        server = self.chat_server
+        if not isinstance(server, ChatServer) or server.federation is not None:
+            post_message('> ', 'Sharded and federated servers can not be upgraded\n', True)
+            return
+        post_message('> ', 'Upgrading Server\n', True)
+        server.stop()
+        self.receive_thread.join()
+        try:
+            self.successor = hand_off(server, [sys.executable] + sys.argv)
+        except UpgradeError as e:
+            post_message('> ', '{0}, carrying on\n'.format(e), True)
+            self.receive_thread = CheckSocketsThread(self, server)
+            self.receive_thread.start()
+            return
+        server_log.info('Upgraded, process {0} took over', self.successor.pid)
+        server_log.close()
+        self.done = True
         return True
 
+    def do_stats(self, line):
+        "Shows the server's metrics"
+        metrics = getattr(self.chat_server, 'metrics', None)
+        if metrics is None:
+            post_message('> ', 'Metrics are not enabled, start the server with --metrics\n', True)
+        else:
+            post_message('> ', metrics.summary(), True)
+
+    def do_memory(self, line):
+        "Shows the memory the server takes for each connection"
+        server = self.chat_server
+        if not isinstance(server, ChatServer):
+            post_message('> ', 'Each worker of a sharded server measures its own memory\n', True)
+            return
+        report = server.memory_report()
+        lines = ['{0} connections, {1} handshakes, {2} detached sessions'.format(
+            report['connections'], report['handshakes'], report['detached'])]
+        if report['resident'] is not None:
+            lines.append('Resident {0} kB, {1} kB at start'.format(report['resident'] // 1024,
+                                                                  server.baseline_memory // 1024))
+        if report['per_connection'] is not None:
+            lines.append('{0:.0f} bytes per connection'.format(report['per_connection']))
+        lines.append('Sessions {0} bytes, {1:.0f} each, queued data {2} bytes'.format(
+            report['sessions'], report['sessions'] / max(report['connections'], 1), report['queued']))
+        lines.append('{0} deflate streams, about {1} kB'.format(report['deflaters'],
+                                                               report['deflaters'] * DEFLATER_MEMORY // 1024))
+        post_message('> ', '\n'.join(lines) + '\n', True)
+
     def preloop(self):
         post_message('> ', 'Welcome to the chat Server.\n', True)
         self.done = False
@@ -39,5 +99,5 @@ class CheckSocketsThread(threading.Thread):
 
     def run(self):
         time.sleep(.1)
-        while not self.server_cmd.done:
-            self.server.check_sockets()
+        if not self.server_cmd.done:
+            self.server.run()
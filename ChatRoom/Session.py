@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import itertools
+import sys
+from bisect import bisect_left, bisect_right, insort
+
+NO_CHANNELS = frozenset()  # shared by every session in no channel, an empty set of its own takes 216 bytes
+
+
+class Session:
+    """State the server keeps for one connected user.
+
+    Sessions have slots rather than a dict, and everything that is only
+    needed while the user is doing something, buffers, rate buckets, held
+    frames, is None or shared until then, so a quiet connection costs a few
+    hundred bytes.
+    """
+    __slots__ = ('connection', 'name', 'address', 'decoder', 'outbox', 'compressor', 'presence', 'channels', 'stream',
+                 'buckets', 'held', 'limited', 'last_seen', 'sequenced', 'token')
+
+    def __init__(self, connection, name, address, decoder=None, outbox=None):
+        self.connection = connection
+        self.name = name
+        self.address = address
+        self.decoder = decoder
+        self.outbox = outbox
+        self.compressor = None
+        self.presence = 'events'
+        self.channels = NO_CHANNELS
+        self.stream = None
+        self.buckets = None
+        self.held = None
+        self.limited = False
+        self.last_seen = 0
+        self.sequenced = False
+        self.token = None
+
+    def footprint(self):
+        """Returns the bytes taken by the session's own objects.
+
+        Queued data is left out, recipients of a broadcast share it, and so
+        are deflate streams, which zlib allocates outside Python.
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.connection)
+        if self.outbox is not None:
+            size += sys.getsizeof(self.outbox)
+            if self.outbox.chunks is not None:
+                size += sys.getsizeof(self.outbox.chunks)
+        if self.decoder is not None:
+            size += sys.getsizeof(self.decoder) + sys.getsizeof(self.decoder.buffer)
+        if self.compressor is not None:
+            size += sys.getsizeof(self.compressor)
+        if self.channels:
+            size += sys.getsizeof(self.channels)
+        if self.buckets is not None:
+            size += sys.getsizeof(self.buckets) + sum(sys.getsizeof(x) for x in self.buckets.values())
+        return size
+
+
+class Handshake:
+    """A client that connected and has not finished introducing itself.
+
+    The decoder is only created once the first bytes show the client speaks
+    the framed protocol. The deadline is the monotonic time the client is
+    dropped at if it still has not.
+    """
+    __slots__ = ('connection', 'address', 'deadline', 'decoder')
+
+    def __init__(self, connection, address, deadline):
+        self.connection = connection
+        self.address = address
+        self.deadline = deadline
+        self.decoder = None
+
+
+class RemoteUser:
+    """A user connected to another server, reached through the link to that server.
+
+    The origin is the id of the server the user is connected to, when it is
+    known, and the channels are the ones that server said the user is in.
+    """
+    __slots__ = ('name', 'link', 'origin', 'channels')
+    connection = None
+
+    def __init__(self, name, link, origin=None):
+        self.name = name
+        self.link = link
+        self.origin = origin
+        self.channels = NO_CHANNELS
+
+
+class SessionRegistry:
+    """Index of the connected users by socket and by name.
+
+    Iterating the registry gives the local sessions, while the name index and
+    roster also hold the remote users. The names are kept sorted, giving the
+    roster a stable order that can be paged through without copying it.
+    """
+    def __init__(self):
+        self.by_socket = {}
+        self.by_name = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.by_socket)
+
+    def __iter__(self):
+        return iter(self.by_socket.values())
+
+    def __contains__(self, connection):
+        return connection in self.by_socket
+
+    def add(self, session):
+        """Registers a session or remote user, its name must not already be taken."""
+        if session.name in self.by_name:
+            raise KeyError('Username {0} already taken'.format(session.name))
+        if session.connection is not None:
+            self.by_socket[session.connection] = session
+        self.by_name[session.name] = session
+        insort(self.names, session.name)
+
+    def remove(self, session):
+        """Removes a session or remote user from every index."""
+        if session.connection is not None:
+            del self.by_socket[session.connection]
+        del self.by_name[session.name]
+        del self.names[bisect_left(self.names, session.name)]
+
+    def get(self, connection):
+        """Returns the session using a socket, or None."""
+        return self.by_socket.get(connection)
+
+    def find(self, name):
+        """Returns the session using a name, or None."""
+        return self.by_name.get(name)
+
+    def sockets(self):
+        """Returns a view of the sockets of every session."""
+        return self.by_socket.keys()
+
+    def names_after(self, after, prefix, count):
+        """Returns up to count names in roster order after the name after (None to start), that start with prefix."""
+        start = bisect_left(self.names, prefix)
+        if after is not None:
+            start = max(start, bisect_right(self.names, after))
+        names = self.names[start:start + count]
+        if prefix and names and not names[-1].startswith(prefix):
+            names = list(itertools.takewhile(lambda x: x.startswith(prefix), names))
+        return names
+
+    def count_prefix(self, prefix):
+        """Returns the number of names that start with prefix."""
+        # Names with the prefix sort before the prefix with its last character bumped, a last character that
+        # can not be bumped is dropped first
+        stem = prefix.rstrip('\U0010ffff')
+        if stem:
+            end = bisect_left(self.names, stem[:-1] + chr(ord(stem[-1]) + 1))
+        else:
+            end = len(self.names)
+        return end - bisect_left(self.names, prefix)
+
+    def roster_size(self):
+        """Returns the number of local and remote users."""
+        return len(self.names)
+
+    def page(self, start, count):
+        """Returns up to count names in roster order, starting at index start."""
+        return self.names[start:start + count]
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+import os
+import selectors
+import signal
+from .ServerLog import *
+from .Protocol import *
+from .Outbox import *
+from .ServerModule import *
+from socket import *
+
+CLAIM_TIMEOUT = 5
+DROPPABLE_TAGS = ('message', 'channel', 'whisper')
+
+
+class ShardLink:
+    """A worker's connection to the hub that joins the shards into one server."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.backlog = []
+
+    def send(self, tag, message=''):
+        """Sends an event to the hub."""
+        self.sock.sendall(encode_frame(tag, message))
+
+    def claim(self, name):
+        """Asks the hub for a username, blocking until it answers or CLAIM_TIMEOUT passes.
+
+        Events that arrive while waiting are kept in the backlog.
+        """
+        self.send('claim', name)
+        answer = None
+        self.sock.settimeout(CLAIM_TIMEOUT)
+        try:
+            while answer is None:
+                data = self.sock.recv(2 ** 16)
+                if not data:
+                    raise ConnectionError('Lost the connection to the shard hub')
+                for tag, message in self.decoder.feed(data):
+                    if tag == 'claimed' and answer is None:
+                        answer = message == '1 ' + name
+                    else:
+                        self.backlog.append((tag, message))
+        except timeout:
+            raise ConnectionError('The shard hub did not answer a claim')
+        finally:
+            self.sock.settimeout(None)
+        return answer
+
+    def receive(self):
+        """Reads the events sent by the hub, after any kept in the backlog.
+
+        A claim may already have read the data that made the socket readable,
+        so the read does not block.
+        """
+        frames = self.take_backlog()
+        try:
+            data = self.sock.recv(2 ** 16, MSG_DONTWAIT)
+        except BlockingIOError:
+            return frames
+        if not data:
+            raise ConnectionError('Lost the connection to the shard hub')
+        frames.extend(self.decoder.feed(data))
+        return frames
+
+    def take_backlog(self):
+        """Returns and clears the events kept while claiming a name."""
+        frames, self.backlog = self.backlog, []
+        return frames
+
+
+class ShardHub:
+    """Relays events between the shard workers and decides who owns each username.
+
+    Claims are handled one at a time in the order they arrive, so two workers
+    can never both accept the same name. Messages for a worker that is not
+    keeping up are dropped, but a worker that can not take claims, joins or
+    leaves any more is dropped itself, since its roster would go wrong.
+    """
+    def __init__(self, links):
+        self.selector = selectors.DefaultSelector()
+        self.decoders = {}
+        self.outboxes = {}
+        self.owners = {}
+        self.running = False
+        for link in links:
+            link.setblocking(False)
+            self.decoders[link] = FrameDecoder()
+            self.outboxes[link] = Outbox()
+            self.selector.register(link, selectors.EVENT_READ)
+
+    def run(self):
+        """Relays events until the hub is stopped."""
+        self.running = True
+        while self.running and self.decoders:
+            for key, events in self.selector.select(.1):
+                if key.fileobj not in self.decoders:
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    self.flush(key.fileobj)
+                if events & selectors.EVENT_READ:
+                    self.read(key.fileobj)
+
+    def stop(self):
+        """Stops the loop started by run."""
+        self.running = False
+
+    def close(self):
+        """Tells every worker to shut down."""
+        for link in list(self.decoders):
+            link.setblocking(True)
+            self.send(link, 'shutdown')
+            if link in self.decoders:
+                self.drop(link)
+        self.selector.close()
+
+    def read(self, link):
+        """Reads and relays the events sent by a worker."""
+        try:
+            data = link.recv(2 ** 16)
+        except ConnectionResetError:
+            data = b''
+        if not data:
+            server_log.error('Lost a shard worker')
+            self.drop(link)
+            return
+        for tag, message in self.decoders[link].feed(data):
+            if link not in self.decoders:
+                break
+            if tag == 'claim':
+                if message in self.owners:
+                    self.send(link, 'claimed', '0 ' + message)
+                else:
+                    self.owners[message] = link
+                    self.send(link, 'claimed', '1 ' + message)
+                    self.send_others(link, 'join', message)
+            elif tag == 'leave':
+                if self.owners.get(message) is link:
+                    del self.owners[message]
+                    self.send_others(link, 'leave', message)
+            elif tag in ('message', 'channel', 'channel_join', 'channel_leave'):
+                self.send_others(link, tag, message)
+            elif tag == 'whisper':
+                target, rest = split_message(message)
+                owner = self.owners.get(target)
+                if owner is not None:
+                    self.send(owner, tag, message)
+
+    def drop(self, link):
+        """Forgets a worker and the users connected to it."""
+        self.selector.unregister(link)
+        link.close()
+        del self.decoders[link]
+        del self.outboxes[link]
+        for name in [k for k, v in self.owners.items() if v is link]:
+            del self.owners[name]
+            self.send_others(link, 'leave', name)
+
+    def send_others(self, sender, tag, message=''):
+        """Sends an event to every worker except the one it came from."""
+        data = encode_frame(tag, message)
+        for link in list(self.decoders):
+            if link is not sender:
+                self.queue(link, tag, data)
+
+    def send(self, link, tag, message=''):
+        """Sends an event to one worker."""
+        self.queue(link, tag, encode_frame(tag, message))
+
+    def queue(self, link, tag, data):
+        """Queues data for a worker, the hub never blocks on a slow worker."""
+        outbox = self.outboxes.get(link)
+        if outbox is None:
+            # Dropped while relaying this batch
+            return
+        if not outbox.append(data):
+            if tag in DROPPABLE_TAGS:
+                server_log.warning('Shard worker is not keeping up, dropping an event')
+            else:
+                server_log.error('Shard worker is not keeping up, dropping the worker')
+                self.drop(link)
+                return
+        self.flush(link)
+
+    def flush(self, link):
+        """Writes what the worker's socket accepts and waits for it to be writable if anything is left."""
+        try:
+            remaining = self.outboxes[link].flush(link)
+        except OSError:
+            remaining = 0
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if remaining else 0)
+        if self.selector.get_key(link).events != events:
+            self.selector.modify(link, events)
+
+
+class ShardedServer:
+    """Forks the workers that share the listening port and runs the hub between them."""
+    def __init__(self, port, workers, use_async=False, **options):
+        self.pids = []
+        links = []
+        server_class = AsyncChatServer if use_async else ChatServer
+        for i in range(workers):
+            hub_end, worker_end = socketpair(AF_UNIX, SOCK_STREAM)
+            pid = os.fork()
+            if pid == 0:
+                for link in links:
+                    link.close()
+                hub_end.close()
+                if options.get('history_dir'):
+                    options['history_dir'] = os.path.join(options['history_dir'], 'worker{0}'.format(i))
+                if server_log.path is not None:
+                    server_log.configure(path='{0}.worker{1}'.format(server_log.path, i))
+                run_worker(server_class, port, worker_end, options)
+            worker_end.close()
+            links.append(hub_end)
+            self.pids.append(pid)
+        self.hub = ShardHub(links)
+        server_log.info('Started {0} workers on port {1}', workers, port)
+
+    def run(self):
+        """Runs the hub until the server is stopped."""
+        self.hub.run()
+
+    def stop(self):
+        """Stops the hub."""
+        self.hub.stop()
+
+    def close(self):
+        """Shuts down the workers and waits for them to exit."""
+        self.hub.close()
+        for pid in self.pids:
+            os.waitpid(pid, 0)
+
+
+def run_worker(server_class, port, link_sock, options):
+    """Serves clients in a forked worker until the hub tells it to shut down."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    status = 0
+    try:
+        server = server_class(port, reuse_port=True, shard=ShardLink(link_sock), **options)
+        server.run()
+        server.close()
+    except Exception as e:
+        server_log.error('Shard worker {0} failed: {1}', os.getpid(), e)
+        status = 1
+    server_log.close()
+    os._exit(status)
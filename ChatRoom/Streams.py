@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+from .Protocol import *
+
+ROSTER_FRAME = 256
+
+
+class HistoryReplay:
+    """Replays the history from a sequence number up to end, one frame each time the user's outbox has room.
+
+    Only the position is kept, the records are read from the history as
+    they are sent, so replaying the whole on-disk log costs no memory. A
+    resume replay leaves out what the user sent and ends with a resumed
+    frame, a history replay ends with history_end.
+    """
+    __slots__ = ('seq', 'end', 'resume', 'missed', 'count', 'finished')
+
+    def __init__(self, seq, end, resume=False, missed=0, count=0, finished=False):
+        self.seq = seq
+        self.end = end
+        self.resume = resume
+        self.missed = missed
+        self.count = count
+        self.finished = finished
+
+    def next_frame(self, server, session):
+        """Returns the next frame of the replay, or None once it is over."""
+        history = server.history
+        while self.seq < self.end:
+            # Records dropped from the ring while replaying are skipped
+            seq = max(self.seq, history.first_seq())
+            record = history.get(seq) if seq < self.end else None
+            self.seq = seq + 1
+            if record is None or not server.can_see(session, record):
+                continue
+            if not self.resume:
+                self.count += 1
+                return 'history', '{0} {1} {2}'.format(*record)
+            if server.sent_by(session, record):
+                continue
+            seq, tag, body = record
+            if tag == 'whisper':
+                body = split_message(body)[1]
+            self.count += 1
+            return tag, '{0} {1}'.format(seq, body)
+        if self.finished:
+            return None
+        self.finished = True
+        if self.resume:
+            return 'resumed', '{0} {1}'.format(self.count, self.missed)
+        return 'history_end', str(self.count)
+
+    def state(self):
+        """Returns the position of the replay, for a new process to carry on from."""
+        return 'history', self.seq, self.end, self.resume, self.missed, self.count, self.finished
+
+
+class RosterPage:
+    """Sends a page of the roster a few hundred names per frame, then the cursor and number of matches.
+
+    Each frame looks up the names after the last one sent, so users joining
+    or leaving during the page do not upset it. left is the number of names
+    still to send, None for every name.
+    """
+    __slots__ = ('after', 'prefix', 'left', 'finished')
+
+    def __init__(self, after, prefix, left=None, finished=False):
+        self.after = after
+        self.prefix = prefix
+        self.left = left
+        self.finished = finished
+
+    def next_frame(self, server, session):
+        """Returns the next frame of the page, or None once it is over."""
+        sessions = server.sessions
+        if self.left is None or self.left > 0:
+            count = ROSTER_FRAME if self.left is None else min(ROSTER_FRAME, self.left)
+            names = sessions.names_after(self.after, self.prefix, count)
+            if names:
+                self.after = names[-1]
+                if self.left is not None:
+                    self.left -= len(names)
+                return 'users', ' '.join(names)
+            self.left = 0
+        if self.finished:
+            return None
+        self.finished = True
+        more = self.after is not None and bool(sessions.names_after(self.after, self.prefix, 1))
+        return 'users_end', '{0} {1}'.format(encode_cursor(self.after) if more else '-',
+                                             sessions.count_prefix(self.prefix))
+
+    def state(self):
+        """Returns the position of the page, for a new process to carry on from."""
+        return 'users', self.after, self.prefix, self.left, self.finished
+
+
+STREAMS = {'history': HistoryReplay, 'users': RosterPage}
+
+
+def restore_stream(state):
+    """Makes a stream again from the position its state gave."""
+    return STREAMS[state[0]](*state[1:])
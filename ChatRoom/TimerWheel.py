@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import math
+import time
+
+WHEEL_RESOLUTION = .1
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 4
+
+
+class TimerWheel:
+    """Hierarchical timing wheel holding items until their deadline.
+
+    Level 0 has one slot per resolution step, each higher level has slots
+    covering a whole turn of the level below it. Timers far in the future
+    wait in a high level and are moved down a level each time its slot comes
+    up, so scheduling is O(1) and each step only touches the timers that are
+    due or moving down, however many timers there are. Deadlines are rounded
+    up to the resolution.
+    """
+    def __init__(self, resolution=WHEEL_RESOLUTION, slots=WHEEL_SLOTS, levels=WHEEL_LEVELS, now=None):
+        self.resolution = resolution
+        self.slots = slots
+        self.spans = [slots ** level for level in range(levels)]
+        self.wheels = [[[] for i in range(slots)] for level in range(levels)]
+        self.started = time.monotonic() if now is None else now
+        self.current = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, deadline, item):
+        """Adds an item that advance returns once deadline, a monotonic time, has passed."""
+        ticks = math.ceil((deadline - self.started) / self.resolution)
+        self.insert(max(ticks, self.current + 1), item)
+        self.count += 1
+
+    def insert(self, ticks, item):
+        ticks = max(ticks, self.current)
+        slot = ticks
+        delta = ticks - self.current
+        for level, span in enumerate(self.spans):
+            if delta < span * self.slots:
+                break
+        else:
+            # Further than the wheel reaches, it comes back to the top level until it is in range
+            slot = self.current + span * (self.slots - 1)
+        self.wheels[level][(slot // span) % self.slots].append((ticks, item))
+
+    def advance(self, now):
+        """Moves the wheel up to now and returns the items that are due, in deadline order."""
+        target = int((now - self.started) / self.resolution)
+        due = []
+        while self.current < target:
+            self.current += 1
+            current = self.current
+            for level in range(len(self.spans) - 1, 0, -1):
+                span = self.spans[level]
+                if current % span == 0:
+                    slot = self.wheels[level][(current // span) % self.slots]
+                    if slot:
+                        entries = list(slot)
+                        slot.clear()
+                        for ticks, item in entries:
+                            self.insert(ticks, item)
+            slot = self.wheels[0][current % self.slots]
+            if slot:
+                due.extend(item for ticks, item in slot)
+                self.count -= len(slot)
+                slot.clear()
+        return due
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import pickle
+import struct
+import subprocess
+from socket import *
+
+UPGRADE_TIMEOUT = 30
+FD_BATCH = 200  # SCM_RIGHTS takes at most 253 descriptors per message
+STATE_HEADER = struct.Struct('!IQ')  # number of sockets, length of the pickled state
+UPGRADE_FD_OPTION = '--upgrade-fd'
+
+
+class UpgradeError(Exception):
+    """Raised when a new server process could not take over from the running one."""
+    pass
+
+
+def hand_off(server, command):
+    """Starts command as a new server process and hands it the server's sockets and state.
+
+    The sockets go over a Unix socket pair with SCM_RIGHTS, the state is
+    pickled after them. The new process is told the descriptor of its end
+    with --upgrade-fd and answers once it serves every connection, only then
+    are this process's copies of the sockets closed. Returns the new process.
+    If it fails, the new process is killed and UpgradeError raised, this
+    server still has everything and can keep running.
+    """
+    ours, theirs = socketpair(AF_UNIX, SOCK_STREAM)
+    command = strip_upgrade_option(command) + [UPGRADE_FD_OPTION, str(theirs.fileno())]
+    try:
+        process = subprocess.Popen(command, pass_fds=(theirs.fileno(),))
+    except OSError as e:
+        ours.close()
+        raise UpgradeError('Could not start the new server: {0}'.format(e))
+    finally:
+        theirs.close()
+    try:
+        ours.settimeout(UPGRADE_TIMEOUT)
+        sockets, state = server.snapshot()
+        send_state(ours, sockets, state)
+        if ours.recv(1) != b'K':
+            raise UpgradeError('The new server did not take over')
+    except (OSError, pickle.PicklingError, UpgradeError) as e:
+        process.kill()
+        process.wait()
+        server.abort_upgrade()
+        raise UpgradeError('Upgrade failed: {0}'.format(e))
+    finally:
+        ours.close()
+    server.release()
+    return process
+
+
+def take_over(fd):
+    """Receives the sockets and state handed off by the old server, on the descriptor given with --upgrade-fd.
+
+    Returns the channel to confirm the take over on with confirm, the
+    sockets, the listening socket first, and the state.
+    """
+    channel = socket(fileno=fd)
+    channel.settimeout(UPGRADE_TIMEOUT)
+    sockets, state = receive_state(channel)
+    return channel, sockets, state
+
+
+def confirm(channel):
+    """Tells the old server the new one is serving its connections, it then lets go of them."""
+    channel.sendall(b'K')
+    channel.close()
+
+
+def send_state(channel, sockets, state):
+    data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+    channel.sendall(STATE_HEADER.pack(len(sockets), len(data)))
+    fds = [x.fileno() for x in sockets]
+    for i in range(0, len(fds), FD_BATCH):
+        send_fds(channel, [b'F'], fds[i:i + FD_BATCH])
+    channel.sendall(data)
+
+
+def receive_state(channel):
+    count, length = STATE_HEADER.unpack(receive_exactly(channel, STATE_HEADER.size))
+    fds = []
+    while len(fds) < count:
+        data, received, flags, address = recv_fds(channel, 1, FD_BATCH)
+        if not data:
+            raise UpgradeError('The old server went away')
+        fds.extend(received)
+    sockets = [socket(fileno=fd) for fd in fds]
+    return sockets, pickle.loads(receive_exactly(channel, length))
+
+
+def receive_exactly(channel, length):
+    """Reads length bytes from a socket."""
+    data = bytearray()
+    while len(data) < length:
+        chunk = channel.recv(min(length - len(data), 2 ** 20))
+        if not chunk:
+            raise UpgradeError('The old server went away')
+        data += chunk
+    return bytes(data)
+
+
+def strip_upgrade_option(command):
+    """Removes the --upgrade-fd option a server that was itself upgraded was started with."""
+    command = list(command)
+    while UPGRADE_FD_OPTION in command:
+        index = command.index(UPGRADE_FD_OPTION)
+        del command[index:index + 2]
+    return command
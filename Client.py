@@ -7,6 +7,16 @@ parser = argparse.ArgumentParser(description='Chat room client')
 parser.add_argument('--server', help='ip of the chat room server')
 parser.add_argument('--port', help='port of the chat room server', type=int)
 parser.add_argument('--username', help='username to use when connection to the chat room')
+parser.add_argument('--no-presence', help='do not show users connecting and disconnecting',
+                    action='store_false', dest='presence')
+parser.add_argument('--no-reconnect', help='do not reconnect when the connection to the server is lost',
+                    action='store_false', dest='reconnect')
+parser.add_argument('--legacy', help='connect to an old server that only speaks the legacy protocol',
+                    action='store_true')
+parser.add_argument('--render-interval', help='seconds between redraws of incoming messages, 0 to draw each at once',
+                    type=float, default=RENDER_INTERVAL)
+parser.add_argument('--max-backlog', help='incoming messages to queue between redraws before older ones are skipped',
+                    type=int, default=MAX_BACKLOG)
 
 args = parser.parse_args()
 
@@ -30,7 +40,8 @@ else:
 
 
 def main():
-    ChatClientCMD(server, port, username).cmdloop()
+    ChatClientCMD(server, port, username, args.presence, args.reconnect, args.render_interval,
+                  args.max_backlog, args.legacy).cmdloop()
 
 if __name__ == '__main__':
     sys.exit(main())
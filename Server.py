@@ -1,17 +1,109 @@
 #!/usr/bin/env python3
 import argparse
+import os
 from ChatRoom.ServerUI import *
 import sys
 
 parser = argparse.ArgumentParser(description='Chat room Server')
 parser.add_argument('port', help='the port to listen on', type=int)
-# parser.add_argument('--verbose', help='increase verbosity', action='store_true')
+parser.add_argument('--async', help='use the asyncio event loop engine', action='store_true',
+                    dest='use_async')
+parser.add_argument('--high-water', help='bytes queued for a client before it counts as slow',
+                    type=int, default=HIGH_WATER)
+parser.add_argument('--slow-timeout', help='seconds a slow client may stay behind before it is disconnected',
+                    type=float, default=SLOW_TIMEOUT)
+parser.add_argument('--flush-delay', help='seconds to hold data queued for a client so more is written at once',
+                    type=float, default=FLUSH_DELAY)
+parser.add_argument('--compress-threshold', help='smallest message in bytes compressed for clients that ask for it',
+                    type=int, default=COMPRESS_THRESHOLD)
+parser.add_argument('--no-compression', help='never compress messages', action='store_true')
+parser.add_argument('--backlog', help='connections the kernel queues before the server accepts them',
+                    type=int, default=BACKLOG)
+parser.add_argument('--handshake-timeout', help='seconds a new connection has to send its hello',
+                    type=float, default=HANDSHAKE_TIMEOUT)
+parser.add_argument('--presence-window', help='seconds joins and leaves are gathered for before they are sent',
+                    type=float, default=PRESENCE_WINDOW)
+parser.add_argument('--rate', help='messages per second each connection may send on average',
+                    type=float, default=MESSAGE_RATE)
+parser.add_argument('--burst', help='messages each connection may send at once', type=float, default=MESSAGE_BURST)
+parser.add_argument('--tag-rate', help='rate limit for one message tag as tag=rate[:burst], may be repeated',
+                    action='append', default=[], type=parse_limit)
+parser.add_argument('--rate-policy', help='what to do with messages over the limit: delay reading them, drop them '
+                                          'or disconnect the sender', choices=POLICIES, default=DELAY)
+parser.add_argument('--fanout-budget', help='deliveries per second of user messages across the whole server',
+                    type=float)
+parser.add_argument('--no-rate-limit', help='do not limit how fast clients may send', action='store_true')
+parser.add_argument('--ping-interval', help='seconds a client may stay quiet before it is pinged',
+                    type=float, default=PING_INTERVAL)
+parser.add_argument('--idle-timeout', help='seconds a client may stay quiet before it is disconnected',
+                    type=float, default=IDLE_TIMEOUT)
+parser.add_argument('--resume-window', help='seconds a disconnected session can be resumed for',
+                    type=float, default=RESUME_WINDOW)
+parser.add_argument('--no-resume', help='do not let clients resume their session after reconnecting',
+                    action='store_true')
+parser.add_argument(UPGRADE_FD_OPTION, help=argparse.SUPPRESS, type=int, dest='upgrade_fd')
+parser.add_argument('--workers', help='number of worker processes sharing the port', type=int, default=0)
+parser.add_argument('--server-id', help='name of this server in a federation, defaults to host:port')
+parser.add_argument('--peer', help='host:port of a server to federate with, may be repeated',
+                    action='append', default=[])
+parser.add_argument('--federation-secret', help='secret peers must share to link, defaults to the '
+                                                'CHAT_FEDERATION_SECRET environment variable',
+                    default=os.environ.get('CHAT_FEDERATION_SECRET'))
+parser.add_argument('--history-size', help='number of recent messages kept in memory',
+                    type=int, default=HISTORY_SIZE)
+parser.add_argument('--history-dir', help='directory of the on-disk message log, history is only kept in memory '
+                                          'if not given')
+parser.add_argument('--metrics', help='keep counters and histograms, shown by the stats command',
+                    action='store_true')
+parser.add_argument('--metrics-port', help='serve the metrics over HTTP on this localhost port', type=int)
+parser.add_argument('--metrics-socket', help='serve the metrics on a Unix socket at this path')
+parser.add_argument('--log-level', help='lowest level of the records logged, debug echoes every message',
+                    choices=sorted(LEVELS, key=LEVELS.get), default='info')
+parser.add_argument('--log-file', help='file to log to instead of the console, rotated when it grows too large')
+parser.add_argument('--quiet', help='only log warnings and errors', action='store_true')
 
 args = parser.parse_args()
+if args.idle_timeout <= args.ping_interval:
+    parser.error('--idle-timeout must be longer than --ping-interval')
+if args.workers and (args.server_id or args.peer):
+    parser.error('--workers can not be combined with federation')
+if args.workers and (args.metrics or args.metrics_port or args.metrics_socket):
+    parser.error('--workers can not be combined with metrics')
 
 
 def main():
-    ChatServerCMD(args.port).cmdloop()
+    server_log.configure(WARNING if args.quiet else LEVELS[args.log_level], args.log_file)
+    federation = None
+    if args.server_id or args.peer:
+        server_id = args.server_id or '{0}:{1}'.format(gethostname(), args.port)
+        federation = Federation(server_id, [parse_address(x) for x in args.peer], args.federation_secret)
+    limits = None
+    if not args.no_rate_limit:
+        limits = RateLimits(args.rate, args.burst, dict(args.tag_rate), args.rate_policy, args.fanout_budget)
+    metrics = None
+    if args.metrics or args.metrics_port or args.metrics_socket:
+        metrics = Metrics(args.metrics_port, args.metrics_socket)
+    if args.use_async:
+        raise_fd_limit()
+    channel = listener = None
+    if args.upgrade_fd is not None:
+        channel, sockets, state = take_over(args.upgrade_fd)
+        listener = sockets[0]
+    server_cmd = ChatServerCMD(args.port, args.use_async, args.workers, listener=listener,
+                               high_water=args.high_water, slow_timeout=args.slow_timeout, backlog=args.backlog,
+                               handshake_timeout=args.handshake_timeout, presence_window=args.presence_window,
+                               limits=limits, ping_interval=args.ping_interval, idle_timeout=args.idle_timeout,
+                               resume_window=None if args.no_resume else args.resume_window,
+                               flush_delay=args.flush_delay, federation=federation,
+                               compress_threshold=None if args.no_compression else args.compress_threshold,
+                               history_size=args.history_size, history_dir=args.history_dir, metrics=metrics)
+    if channel is not None:
+        server_cmd.chat_server.restore(state, sockets)
+        confirm(channel)
+    server_cmd.cmdloop()
+    if server_cmd.successor is not None:
+        # The new server reads the terminal now, waiting keeps it in the foreground
+        return server_cmd.successor.wait()
 
 if __name__ == '__main__':
     sys.exit(main())
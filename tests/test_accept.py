@@ -0,0 +1,29 @@
+import unittest
+from socket import create_connection
+from ChatRoom.ServerModule import *
+
+
+class AcceptTest(unittest.TestCase):
+    def setUp(self):
+        server_log.configure(ERROR)
+        self.server = ChatServer(0)
+        self.client = create_connection(('127.0.0.1', self.server.server_sock.getsockname()[1]))
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def test_accepts_below_the_select_limit(self):
+        self.server.check_sockets(.5)
+        self.assertEqual(len(self.server.HANDSHAKES), 1)
+
+    def test_refuses_sockets_select_can_not_watch(self):
+        self.server.max_fd = self.server.server_sock.fileno()
+        self.server.check_sockets(.5)
+        self.assertEqual(len(self.server.HANDSHAKES), 0)
+        self.assertEqual(self.client.recv(1), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
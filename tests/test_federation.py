@@ -0,0 +1,39 @@
+import unittest
+from socket import create_connection
+from ChatRoom.ServerModule import *
+from ChatRoom.FederationModule import *
+
+
+class PeerSecretTest(unittest.TestCase):
+    def setUp(self):
+        server_log.configure(ERROR)
+        self.federation = Federation('A', secret='s3cret')
+        self.server = ChatServer(0, federation=self.federation)
+        self.peer = create_connection(('127.0.0.1', self.server.server_sock.getsockname()[1]))
+        self.peer.settimeout(1)
+
+    def tearDown(self):
+        self.server.close()
+        self.peer.close()
+
+    def link(self, hello):
+        self.peer.sendall(encode_frame('peer', hello))
+        for i in range(5):
+            self.server.check_sockets(.02)
+        return self.peer.recv(2 ** 16)
+
+    def test_refuses_a_peer_without_the_secret(self):
+        self.assertEqual(self.link('X wrong'), b'')
+        self.assertEqual(len(self.federation.links), 0)
+
+    def test_refuses_a_peer_with_no_secret(self):
+        self.assertEqual(self.link('X'), b'')
+        self.assertEqual(len(self.federation.links), 0)
+
+    def test_links_a_peer_with_the_secret(self):
+        self.assertEqual(FrameDecoder().feed(self.link('X s3cret')), [('peer', 'A')])
+        self.assertEqual(len(self.federation.links), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
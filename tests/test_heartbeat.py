@@ -0,0 +1,47 @@
+import time
+import unittest
+from socket import socketpair
+from ChatRoom.ServerModule import *
+
+
+class HeartbeatTest(unittest.TestCase):
+    def setUp(self):
+        server_log.configure(ERROR)
+
+    def tearDown(self):
+        self.server.close()
+        self.peer.close()
+
+    def connect(self, **options):
+        self.server = ChatServer(0, **options)
+        connection, self.peer = socketpair()
+        connection.setblocking(False)
+        session = Session(connection, 'alice', None, FrameDecoder(), Outbox())
+        self.server.sessions.add(session)
+        self.server.watch_idle(session)
+        return session
+
+    def received(self, duration):
+        """Runs the server loop for duration seconds and returns the frames the client got."""
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            self.server.check_sockets(.02)
+        self.peer.setblocking(False)
+        return FrameDecoder().feed(self.peer.recv(2 ** 16))
+
+    def test_pings_again_without_idle_timeout(self):
+        self.connect(ping_interval=.1, idle_timeout=None)
+        pings = [x for x in self.received(.6) if x[0] == 'ping']
+        self.assertGreater(len(pings), 1)
+        self.assertLess(len(pings), 7)
+
+    def test_idle_timeout_disconnects(self):
+        session = self.connect(ping_interval=.1, idle_timeout=.3, resume_window=None)
+        frames = self.received(.6)
+        self.assertIn(('ping', ''), frames)
+        self.assertEqual(frames[-1], ('error', 'idle_timeout'))
+        self.assertIsNone(self.server.sessions.find(session.name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import errno
+import unittest
+from socket import socket, socketpair
+from ChatRoom.ServerModule import *
+
+
+class LegacyReadTest(unittest.TestCase):
+    def setUp(self):
+        server_log.configure(ERROR)
+        self.server = ChatServer(0)
+        connection, self.peer = socketpair()
+        connection.setblocking(False)
+        self.session = Session(connection, 'alice', None, None, Outbox())
+        self.server.sessions.add(self.session)
+
+    def tearDown(self):
+        self.server.close()
+        self.peer.close()
+
+    def test_invalid_utf8_disconnects(self):
+        self.peer.send('message hé'.encode()[:-1])
+        self.server.handle_readable(self.session.connection)
+        self.assertIsNone(self.server.sessions.find('alice'))
+
+    def test_keepalive_timeout_disconnects(self):
+        class TimedOut(socket):
+            def recv(self, size):
+                raise TimeoutError(errno.ETIMEDOUT, 'Connection timed out')
+        self.server.sessions.remove(self.session)
+        self.session.connection = TimedOut(fileno=self.session.connection.detach())
+        self.server.sessions.add(self.session)
+        self.server.handle_readable(self.session.connection)
+        self.assertIsNone(self.server.sessions.find('alice'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+from socket import socketpair
+from ChatRoom.ServerModule import *
+
+
+class FanoutTest(unittest.TestCase):
+    def setUp(self):
+        server_log.configure(ERROR)
+        self.server = ChatServer(0, limits=RateLimits(fanout=100))
+        self.peers = []
+        for name in ('alice', 'bob'):
+            connection, peer = socketpair()
+            connection.setblocking(False)
+            self.peers.append(peer)
+            session = Session(connection, name, None, FrameDecoder(), Outbox())
+            self.server.sessions.add(session)
+            self.server.join_channel('room', session)
+
+    def tearDown(self):
+        self.server.close()
+        for peer in self.peers:
+            peer.close()
+
+    def test_channel_name_is_normalized(self):
+        self.assertEqual(self.server.fanout('channel', 'room hi'), 2)
+        self.assertEqual(self.server.fanout('channel', '#room hi'), 2)
+
+    def test_bad_channel_name(self):
+        self.assertEqual(self.server.fanout('channel', '# hi'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
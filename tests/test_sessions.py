@@ -0,0 +1,44 @@
+import unittest
+from socket import socketpair
+from ChatRoom.ServerModule import *
+
+
+class CountPrefixTest(unittest.TestCase):
+    def setUp(self):
+        self.sessions = SessionRegistry()
+        for name in ('alice', 'bob', 'bobby', 'z\U0010ffff', 'z\U0010ffffa', '\U0010ffff'):
+            self.sessions.add(RemoteUser(name, None))
+
+    def test_counts_names_with_prefix(self):
+        self.assertEqual(self.sessions.count_prefix(''), 6)
+        self.assertEqual(self.sessions.count_prefix('bob'), 2)
+        self.assertEqual(self.sessions.count_prefix('c'), 0)
+
+    def test_last_code_point(self):
+        self.assertEqual(self.sessions.count_prefix('\U0010ffff'), 1)
+        self.assertEqual(self.sessions.count_prefix('z\U0010ffff'), 2)
+        self.assertEqual(self.sessions.count_prefix('\U0010ffff\U0010ffff'), 0)
+
+
+class UsersRequestTest(unittest.TestCase):
+    def setUp(self):
+        server_log.configure(ERROR)
+        self.server = ChatServer(0)
+        connection, self.peer = socketpair()
+        connection.setblocking(False)
+        self.session = Session(connection, 'alice', None, FrameDecoder(), Outbox())
+        self.server.sessions.add(self.session)
+
+    def tearDown(self):
+        self.server.close()
+        self.peer.close()
+
+    def test_prefix_ending_in_last_code_point(self):
+        self.server.process_message(self.session, 'users', '5 - \U0010ffff')
+        self.peer.settimeout(1)
+        frames = FrameDecoder().feed(self.peer.recv(2 ** 16))
+        self.assertEqual(frames, [('users_end', '- 0')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+from socket import socketpair
+from ChatRoom import ShardModule
+from ChatRoom.ShardModule import *
+
+
+class ShardHubTest(unittest.TestCase):
+    def setUp(self):
+        server_log.configure(ERROR)
+        self.hub_ends = []
+        self.workers = []
+        for i in range(2):
+            hub_end, worker_end = socketpair()
+            self.hub_ends.append(hub_end)
+            self.workers.append(worker_end)
+        self.hub = ShardHub(self.hub_ends)
+        slow = self.hub_ends[1]
+        self.hub.outboxes[slow] = Outbox(2 ** 12)
+        # The slow worker never reads, fill its socket so the outbox has to hold what comes next
+        while slow in self.hub.decoders and not self.hub.outboxes[slow].overflowed:
+            self.hub.send_others(self.hub_ends[0], 'message', 'alice ' + 'x' * 1000)
+        self.hub.outboxes[slow].limit = len(self.hub.outboxes[slow])
+
+    def tearDown(self):
+        for link in list(self.hub.decoders):
+            self.hub.drop(link)
+        self.hub.selector.close()
+        for worker in self.workers:
+            worker.close()
+
+    def test_drops_messages_for_a_slow_worker(self):
+        self.assertIn(self.hub_ends[1], self.hub.decoders)
+
+    def test_drops_a_worker_that_misses_a_join(self):
+        self.hub.send_others(self.hub_ends[0], 'join', 'alice')
+        self.assertNotIn(self.hub_ends[1], self.hub.decoders)
+        self.assertIn(self.hub_ends[0], self.hub.decoders)
+
+
+class ShardLinkTest(unittest.TestCase):
+    def test_claim_times_out(self):
+        ours, hub = socketpair()
+        timeout = ShardModule.CLAIM_TIMEOUT
+        ShardModule.CLAIM_TIMEOUT = .1
+        try:
+            with self.assertRaises(ConnectionError):
+                ShardLink(ours).claim('alice')
+        finally:
+            ShardModule.CLAIM_TIMEOUT = timeout
+            ours.close()
+            hub.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from socket import socketpair
+from ChatRoom.ServerModule import *
+
+
+class AbortUpgradeTest(unittest.TestCase):
+    def setUp(self):
+        server_log.configure(ERROR)
+        self.server = ChatServer(0)
+        connection, self.peer = socketpair()
+        connection.setblocking(False)
+        self.session = Session(connection, 'alice', None, FrameDecoder(), Outbox(1024))
+        self.server.sessions.add(self.session)
+        for i in range(200):
+            self.server.history.append('message', 'bob message {0}'.format(i))
+
+    def tearDown(self):
+        self.server.close()
+        self.peer.close()
+
+    def drain(self):
+        while self.session.stream is not None:
+            self.server.handle_writable(self.session.connection)
+        decoder = FrameDecoder()
+        frames = []
+        self.peer.settimeout(1)
+        while not frames or frames[-1][0] != 'history_end':
+            frames.extend(decoder.feed(self.peer.recv(2 ** 16)))
+        return frames
+
+    def test_replay_goes_on_after_abort(self):
+        self.server.process_message(self.session, 'history', 'last 200')
+        self.assertIsNotNone(self.session.stream)
+        self.server.snapshot()
+        self.server.abort_upgrade()
+        frames = self.drain()
+        self.assertEqual(len([x for x in frames if x[0] == 'history']), 200)
+        self.assertEqual(frames[-1], ('history_end', '200'))
+
+    def test_snapshot_keeps_the_position_of_a_replay(self):
+        self.server.process_message(self.session, 'history', 'last 200')
+        item = self.server.session_state(self.session, 0)
+        [(kind, seq, end, resume, missed, count, finished)] = item['stream']
+        self.assertEqual((kind, end), ('history', 201))
+        self.assertEqual(seq - 1, count)
+        # Carry on in a session made from the state, as the new process would
+        self.server.sessions.remove(self.session)
+        self.session = self.server.restore_session(item, self.session.connection)
+        self.session.outbox = Outbox(1024)
+        self.server.sessions.add(self.session)
+        frames = self.drain()
+        self.assertEqual(len([x for x in frames if x[0] == 'history']), 200)
+        self.assertEqual(frames[-1], ('history_end', '200'))
+
+
+if __name__ == '__main__':
+    unittest.main()